@@ -0,0 +1,78 @@
+# worker_per_chat: chat locks against chat queues with a skewed chat distribution.
+# A share of the updates goes to one hot chat, the rest is spread over 499 chats,
+# the latency of the other chats shows the head-of-line blocking.
+import asyncio
+import random
+import statistics
+import time
+
+from common import StubController
+
+from pyrogram.handlers import RawUpdateHandler
+from pyrogram.raw.types import Message, PeerUser, UpdateNewMessage
+
+from tgdog.wrappers.dispatcher import Dispatcher
+
+UPDATES = 2000
+UPDATE_INTERVAL = 0.0015
+HANDLER_DURATION = 0.01
+WORKERS = 8
+HOT_CHAT_ID = 1
+SKEWS = [0.3, 0.6]
+
+
+class Controller(StubController):
+    worker_per_chat = True
+
+    def __init__(self, chat_queues):
+        self.chat_queues = chat_queues
+        self.updates_queue_watermark = None
+        self.overload_policies = ()
+
+
+class Client:
+    no_updates = False
+    workers = WORKERS
+
+    def __init__(self, controller):
+        self.controller = controller
+
+
+async def run(chat_queues, skew):
+    dispatcher = Dispatcher(Client(Controller(chat_queues)))
+    queued_at = {}
+    latencies = {'hot': [], 'other': []}
+
+    async def handle(update, users, chats):
+        await asyncio.sleep(HANDLER_DURATION)
+        key = 'hot' if update.message.peer_id.user_id == HOT_CHAT_ID else 'other'
+        latencies[key].append(time.monotonic() - queued_at[id(update)])
+    await dispatcher.add_handler(RawUpdateHandler(handle))
+    await dispatcher.start()
+    random.seed(0)
+    # Kept alive, so their ids are not reused.
+    updates = []
+    for i in range(UPDATES):
+        user_id = HOT_CHAT_ID if random.random() < skew else random.randint(2, 500)
+        update = UpdateNewMessage(message=Message(id=i, peer_id=PeerUser(user_id=user_id), date=0, message=''), pts=0, pts_count=0)
+        updates.append(update)
+        queued_at[id(update)] = time.monotonic()
+        dispatcher.updates_queue.put_nowait((update, {}, {}))
+        await asyncio.sleep(UPDATE_INTERVAL)
+    await dispatcher.stop()
+    other = sorted(latencies['other'])
+    mode = 'queues' if chat_queues else 'locks'
+    print(
+        f'{mode:6} {int(skew * 100)}% hot: other chats mean {statistics.mean(other) * 1000:.0f} ms, '
+        f'p95 {other[int(len(other) * 0.95)] * 1000:.0f} ms, hot chat updates handled {len(latencies["hot"])}'
+    )
+
+
+def main():
+    for skew in SKEWS:
+        for chat_queues in (False, True):
+            asyncio.run(run(chat_queues, skew))
+
+
+if __name__ == '__main__':
+    main()
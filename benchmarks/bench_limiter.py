@@ -0,0 +1,65 @@
+# Limiter: CPU cost of many concurrent waiters and the largest number of events in any window of one period.
+# The list-rotation limiter of the previous version is kept here for comparison.
+import asyncio
+import time
+
+from common import StubController, Timer
+
+from tgdog.limiter import Limiter
+
+CASES = [
+    # (waiters, amount, period)
+    (10000, 5000, 1),
+    (10000, 2000, 0.5),
+    (300, 30, 1),
+    (20, 5, 1),
+]
+
+
+class ListLimiter:
+
+    def __init__(self, controller, amount, period):
+        self.period = period
+        self.events = [0]*amount
+
+    async def __call__(self):
+        delay = max(self.period-(time.time()-self.events[0]), 0)
+        self.events.append(time.time()+delay)
+        del self.events[0]
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+def get_max_window_events(times, period):
+    # Small tolerance for the timer resolution.
+    times.sort()
+    result = 0
+    start = 0
+    for end, t in enumerate(times):
+        while times[start] <= t - period + 0.001:
+            start += 1
+        result = max(result, end - start + 1)
+    return result
+
+
+async def run(limiter_class, waiters, amount, period):
+    limiter = limiter_class(StubController(), amount, period)
+    times = []
+
+    async def wait():
+        await limiter()
+        times.append(time.monotonic())
+    with Timer() as timer:
+        await asyncio.gather(*[wait() for i in range(waiters)])
+    return timer, get_max_window_events(times, period)
+
+
+def main():
+    for waiters, amount, period in CASES:
+        for limiter_class in (ListLimiter, Limiter):
+            timer, max_events = asyncio.run(run(limiter_class, waiters, amount, period))
+            print(f'{limiter_class.__name__:11} waiters={waiters} amount={amount} period={period}: {timer}, max events per period {max_events}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+# message_sender: 100k queued messages of three priorities to 5000 chats pushed through a stub client.
+import asyncio
+
+from common import StubClient, StubController, Timer
+
+from tgdog.messages import TGBotMessagesMixin
+
+MESSAGES = 100000
+CHATS = 5000
+MAX_CONCURRENT_SENDINGS_PER_PRIORITY = 23
+
+
+class Client(StubClient):
+
+    async def send_message(self, chat_id, text, *args, limiters, previous_invoke_event, current_invoke_event, **kwargs):
+        # The parts of one chat are sent in order, as the invoke wrapper does.
+        if previous_invoke_event:
+            await previous_invoke_event.wait()
+        await asyncio.sleep(0)
+        result = await super().send_message(chat_id, text)
+        if current_invoke_event:
+            current_invoke_event.set()
+        return result
+
+
+class Controller(TGBotMessagesMixin, StubController):
+
+    def __init__(self):
+        self.app = Client()
+        super().__init__()
+
+
+async def run():
+    controller = Controller()
+    for i in range(MESSAGES):
+        controller.send_message_sync('text', i % CHATS + 1, priority=1 + i % 3)
+    with Timer() as timer:
+        sender = asyncio.create_task(controller.message_sender(MAX_CONCURRENT_SENDINGS_PER_PRIORITY))
+        while controller.app.sent_messages < MESSAGES:
+            await asyncio.sleep(0.01)
+        sender.cancel()
+    print(f'{MESSAGES} messages to {CHATS} chats: {timer}, {MESSAGES / timer.wall:.0f} messages/s')
+
+
+if __name__ == '__main__':
+    asyncio.run(run())
@@ -0,0 +1,93 @@
+# Window reconstruction from a callback query: time and statements per reconstruct of a window with 1 tab and 6 buttons
+# on SQLite. python benchmarks/bench_reconstruct.py [round trip seconds]
+import asyncio
+import os
+import sys
+import tempfile
+import time
+import types
+
+from common import StubController
+
+from sqlalchemy import event
+
+from tgdog.db import TGBotDBMixin, db, tables
+from tgdog.gui import Tab, Window
+from tgdog.gui.buttons import SimpleButton
+from tgdog.gui.callback_query import current_callback_query
+
+ROUND_TRIP = float(sys.argv[1]) if len(sys.argv) > 1 else 0
+RECONSTRUCTS = 50 if ROUND_TRIP else 300
+CHAT_ID = 10
+
+
+class BenchTab(Tab):
+
+    async def build(self, *args, **kwargs):
+        await super().build(*args, **kwargs)
+        for row in range(3):
+            self.keyboard.add_row(*[SimpleButton(f'b{row}{column}') for column in range(2)])
+
+
+class BenchWindow(Window):
+    tabs = [BenchTab]
+
+
+class Controller(TGBotDBMixin, StubController):
+    host = None
+
+    def __init__(self, db_url):
+        self.db_url = db_url
+        self.message = None
+        super().__init__()
+
+    async def send_message(self, text, chat_id, reply_markup=None, **kwargs):
+        self.message = types.SimpleNamespace(id=1, text=text, reply_markup=reply_markup, empty=False)
+        return self.message
+
+    def edit_message_text_sync(self, *args, **kwargs):
+        pass
+
+
+async def run(db_url):
+    controller = Controller(db_url)
+    await controller.init_db()
+    async with controller.db_engine.begin() as connection:
+        await connection.run_sync(tables.Base.metadata.create_all)
+    db.set_context_var_value(controller.session())
+    window = BenchWindow(controller, CHAT_ID, 0)
+    await window.build()
+    await window.render()
+    await db.commit()
+    await db.close()
+    message = controller.message
+    callback_data = message.reply_markup.inline_keyboard[0][0].callback_data
+    current_callback_query.set_context_var_value(types.SimpleNamespace(data=callback_data))
+    statements = 0
+
+    def count_statement(*args):
+        nonlocal statements
+        statements += 1
+        if ROUND_TRIP:
+            time.sleep(ROUND_TRIP)
+    event.listen(controller.db_engine.sync_engine, 'before_cursor_execute', count_statement)
+    start = time.perf_counter()
+    for i in range(RECONSTRUCTS):
+        db.set_context_var_value(controller.session())
+        reconstructed_window = await BenchWindow.reconstruct(controller, CHAT_ID, window.row.id, message=message)
+        assert len(list(reconstructed_window.current_tab.keyboard.buttons_iter())) == 6
+        assert reconstructed_window.current_tab.text.row is not None
+        await db.commit()
+        await db.close()
+    elapsed = (time.perf_counter() - start) / RECONSTRUCTS * 1000
+    await controller.close_db()
+    print(f'round trip {ROUND_TRIP * 1000:.0f} ms: {elapsed:.2f} ms per reconstruct, {statements / RECONSTRUCTS:.1f} statements')
+
+
+def main():
+    with tempfile.TemporaryDirectory() as directory:
+        asyncio.run(run(f'sqlite+aiosqlite:///{os.path.join(directory, "bench.db")}'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+# Callback query routing: HANDLERS prefix-filtered handlers in one group against the same number of routes.
+# The query matches the last handler, so the filters of all the others are checked first.
+import asyncio
+
+from common import StubController, Timer
+
+from pyrogram import filters
+from pyrogram.handlers import CallbackQueryHandler
+from pyrogram.raw.types import PeerUser, UpdateBotCallbackQuery
+
+from tgdog.enums import Category
+from tgdog.wrappers.dispatcher import Dispatcher, LazyUpdate
+
+HANDLERS = 60
+QUERIES = 20000
+
+
+class Client:
+
+    def __init__(self, controller):
+        self.controller = controller
+
+
+class CallbackQuery:
+
+    def __init__(self, data):
+        self.data = data
+
+
+def get_prefix_filter(prefix):
+    async def check(flt, client, callback_query):
+        return callback_query.data.startswith(prefix)
+    return filters.create(check)
+
+
+async def run(routes):
+    dispatcher = Dispatcher(Client(StubController()))
+    handled = 0
+
+    async def callback(*args):
+        nonlocal handled
+        handled += 1
+    for i in range(HANDLERS):
+        if routes:
+            await dispatcher.add_callback_query_route(f'h{i}:', CallbackQueryHandler(callback))
+        else:
+            await dispatcher.add_handler(CallbackQueryHandler(callback, get_prefix_filter(f'h{i}:')), Category.MAIN)
+    data = f'h{HANDLERS - 1}:x'
+    update = UpdateBotCallbackQuery(query_id=1, user_id=1, peer=PeerUser(user_id=1), msg_id=1, chat_instance=0, data=data.encode())
+    packet = (update, {}, {})
+    callback_query = CallbackQuery(data)
+
+    async def parse(*args):
+        return callback_query, CallbackQueryHandler
+    with Timer() as timer:
+        for i in range(QUERIES):
+            await dispatcher.handle_category(Category.MAIN, packet, LazyUpdate(parse, packet), CallbackQueryHandler)
+    mode = 'routes' if routes else 'filters'
+    print(f'{mode:7} {timer.wall / QUERIES * 1e6:.1f} us per callback query ({timer}), handled {handled}')
+
+
+def main():
+    for routes in (False, True):
+        asyncio.run(run(routes))
+
+
+if __name__ == '__main__':
+    main()
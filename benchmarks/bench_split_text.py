@@ -0,0 +1,45 @@
+# split_text for the char, word and line units at 10 KB, 100 KB and 1 MB, and split_text_by_units on the same texts.
+import random
+import time
+
+import common  # noqa: F401
+
+from tgdog.helpers import split_text
+
+SIZES = [10_000, 100_000, 1_000_000]
+UNITS = ['char', 'word', 'line']
+MAX_PART_LENGTH = 4096
+
+
+def make_text(size):
+    random.seed(0)
+    words = [''.join(random.choice('abcdefghij') for i in range(random.randint(1, 10))) for j in range(1000)]
+    lines = []
+    length = 0
+    while length < size:
+        line = ' '.join(random.choice(words) for i in range(random.randint(1, 15)))
+        lines.append(line)
+        length += len(line) + 1
+    return '\n'.join(lines)[:size]
+
+
+def measure(function, *args, **kwargs):
+    start = time.perf_counter()
+    parts = function(*args, **kwargs)
+    return (time.perf_counter() - start) * 1000, len(parts)
+
+
+def main():
+    for size in SIZES:
+        text = make_text(size)
+        results = []
+        for unit in UNITS:
+            elapsed, parts = measure(split_text.split_text, 'Header', text, MAX_PART_LENGTH, unit)
+            results.append(f'{unit} {elapsed:.2f} ms ({parts} parts)')
+        elapsed, parts = measure(split_text.split_text_by_units, 'Header', text, MAX_PART_LENGTH)
+        results.append(f'by units {elapsed:.2f} ms')
+        print(f'{size // 1000} KB: ' + ', '.join(results))
+
+
+if __name__ == '__main__':
+    main()
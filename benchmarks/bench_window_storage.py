@@ -0,0 +1,189 @@
+# Window storages: RelationalStorage against BlobStorage on SQLite.
+# Every window is created, reconstructed and changed by a check box press, which saves its tab and switches to another one,
+# the time and the number of statements are per window. python benchmarks/bench_window_storage.py [round trip seconds]
+import asyncio
+import os
+import sys
+import tempfile
+import time
+import types
+
+from common import StubController
+
+from sqlalchemy import event, func, select
+
+from tgdog.db import TGBotDBMixin, db, tables
+from tgdog.gui import BlobStorage, Tab, TGBotGUIMixin, Window
+from tgdog.gui.buttons import CheckBoxButton, SimpleButton
+from tgdog.gui.callback_query import current_callback_query
+
+ROUND_TRIP = float(sys.argv[1]) if len(sys.argv) > 1 else 0
+WINDOWS = 40 if ROUND_TRIP else 200
+CHAT_ID = 10
+TABLES = (tables.Window, tables.Tab, tables.Text, tables.SimpleButton, tables.CheckBoxButton, tables.PyrogramButton)
+
+
+class MenuTab(Tab):
+
+    async def build(self, *args, **kwargs):
+        await super().build(*args, **kwargs)
+        self.text.set_body('menu')
+        for row in range(3):
+            self.keyboard.add_row(*[SimpleButton(f'b{row}{column}', callback=self.noop) for column in range(2)])
+        self.keyboard.add_row(CheckBoxButton('check', callback=self.on_check))
+
+    async def noop(self, arg):
+        pass
+
+    async def on_check(self, checked, arg):
+        self.text.set_body(f'checked {checked}')
+        await self.window.switch_tab(OtherTab, save_current_tab=True)
+
+
+class OtherTab(Tab):
+
+    async def build(self, *args, **kwargs):
+        await super().build(*args, **kwargs)
+        self.text.set_body('other')
+        self.keyboard.add_row(SimpleButton('back', callback=self.back))
+
+    async def back(self, arg):
+        await self.window.switch_tab(MenuTab)
+
+
+class RelationalWindow(Window):
+    tabs = [MenuTab, OtherTab]
+
+
+class BlobWindow(Window):
+    tabs = [MenuTab, OtherTab]
+    storage_class = BlobStorage
+
+
+class Controller(TGBotDBMixin, TGBotGUIMixin, StubController):
+    host = None
+
+    def __init__(self, db_url):
+        self.db_url = db_url
+        self.messages = {}
+        self.next_message_id = 1
+        super().__init__()
+
+    async def send_message(self, text, chat_id, reply_markup=None, **kwargs):
+        message = types.SimpleNamespace(id=self.next_message_id, text=text, reply_markup=reply_markup, empty=False)
+        self.messages[message.id] = message
+        self.next_message_id += 1
+        return message
+
+    def edit_message_text_sync(self, chat_id, message_id, text, reply_markup=None, **kwargs):
+        message = self.messages[message_id]
+        message.text = text
+        message.reply_markup = reply_markup
+
+    def discard_message_edit(self, *args):
+        pass
+
+
+def set_callback_query(message, button_text=None):
+    buttons = [button for row in message.reply_markup.inline_keyboard for button in row]
+    if button_text is not None:
+        buttons = [button for button in buttons if button.text.endswith(button_text)]
+    current_callback_query.set_context_var_value(types.SimpleNamespace(data=buttons[0].callback_data))
+
+
+async def commit():
+    await db.commit()
+    await db.close()
+
+
+async def press(controller, window_class, window_id, button_text):
+    message = controller.messages[window_id]
+    set_callback_query(message, button_text)
+    db.set_context_var_value(controller.session())
+    window = await window_class.reconstruct(controller, CHAT_ID, window_id, message=message)
+    await window.handle_button_activation()
+    await window.render()
+    await commit()
+
+
+async def run(window_class, db_url):
+    controller = Controller(db_url)
+    await controller.init_db()
+    controller.listen_window_events()
+    async with controller.db_engine.begin() as connection:
+        await connection.run_sync(tables.Base.metadata.create_all)
+    statements = 0
+
+    def count_statement(*args):
+        nonlocal statements
+        statements += 1
+        if ROUND_TRIP:
+            time.sleep(ROUND_TRIP)
+    event.listen(controller.db_engine.sync_engine, 'before_cursor_execute', count_statement)
+    results = {}
+    window_ids = []
+
+    async def measure(name, coroutine):
+        nonlocal statements
+        statements = 0
+        start = time.perf_counter()
+        await coroutine
+        results[name] = (time.perf_counter() - start) / WINDOWS * 1000, statements / WINDOWS
+
+    async def insert():
+        for i in range(WINDOWS):
+            db.set_context_var_value(controller.session())
+            window = window_class(controller, CHAT_ID, 0)
+            await window.build()
+            await window.render()
+            await commit()
+            window_ids.append(window.row.id)
+
+    async def reconstruct():
+        for window_id in window_ids:
+            message = controller.messages[window_id]
+            set_callback_query(message)
+            db.set_context_var_value(controller.session())
+            window = await window_class.reconstruct(controller, CHAT_ID, window_id, message=message)
+            assert len(list(window.current_tab.keyboard.buttons_iter())) == 7
+            await commit()
+
+    async def update():
+        for window_id in window_ids:
+            await press(controller, window_class, window_id, 'check')
+    await measure('insert', insert())
+    await measure('reconstruct', reconstruct())
+    await measure('update', update())
+    # The saved tab is restored with the state of its check box.
+    for window_id in window_ids[:3]:
+        await press(controller, window_class, window_id, 'back')
+        message = controller.messages[window_id]
+        assert message.text == 'checked True', message.text
+        assert message.reply_markup.inline_keyboard[3][0].text == '☑ check'
+    message = controller.messages[window_ids[0]]
+    set_callback_query(message)
+    db.set_context_var_value(controller.session())
+    window = await window_class.reconstruct(controller, CHAT_ID, window_ids[0], message=message)
+    await window.destroy()
+    await commit()
+    async with controller.db_engine.connect() as connection:
+        rows = {t.__tablename__: (await connection.execute(select(func.count()).select_from(t))).scalar() for t in TABLES}
+        blob_size = (await connection.execute(select(func.avg(func.length(tables.Window.state))))).scalar()
+    controller.remove_window_events()
+    await controller.close_db()
+    print(
+        f'{window_class.__name__} round trip {ROUND_TRIP * 1000:.0f} ms: '
+        + ', '.join(f'{name} {ms:.2f} ms / {count:.1f} statements' for name, (ms, count) in results.items())
+    )
+    print(f'  rows left after destroying one window: {rows}, average blob bytes: {blob_size}')
+
+
+def main():
+    with tempfile.TemporaryDirectory() as directory:
+        for window_class in (RelationalWindow, BlobWindow):
+            db_path = os.path.join(directory, f'{window_class.__name__}.db')
+            asyncio.run(run(window_class, f'sqlite+aiosqlite:///{db_path}'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+import asyncio
+import logging
+import os
+import sys
+import time
+
+# The benchmarks are run from a checkout: python benchmarks/<name>.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+logging.disable(logging.CRITICAL)
+
+
+class StubController:
+    # What the measured components need from the bot controller.
+    log = logging.getLogger('tgdog.benchmarks')
+
+
+class StubClient:
+    # Stands in for pyrogram.Client, every request takes latency seconds.
+
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.sent_messages = 0
+
+    async def send_message(self, chat_id, text, *args, **kwargs):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self.sent_messages += 1
+        return object()
+
+
+class Timer:
+    # Wall and CPU time of the block.
+
+    def __enter__(self):
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+        return self
+
+    def __exit__(self, *args):
+        self.wall = time.perf_counter() - self.wall
+        self.cpu = time.process_time() - self.cpu
+
+    def __str__(self):
+        return f'{self.wall:.3f}s wall / {self.cpu:.3f}s CPU'
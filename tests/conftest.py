@@ -0,0 +1,37 @@
+import logging
+
+import pytest
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from tgdog.db import tables
+
+
+def create_controller(*bases, **attributes):
+    # The attributes are set before the mixins are initialized, as the bot controller does with its arguments.
+    controller_class = type('Controller', bases or (object,), {})
+    controller = controller_class.__new__(controller_class)
+    controller.log = logging.getLogger('tgdog.tests')
+    controller.__dict__.update(attributes)
+    controller_class.__init__(controller)
+    return controller
+
+
+@pytest.fixture
+def make_controller():
+    return create_controller
+
+
+@pytest.fixture
+def db_url(tmp_path):
+    return f'sqlite+aiosqlite:///{tmp_path / "test.db"}'
+
+
+@pytest.fixture
+def create_engine(db_url):
+    # Called inside the event loop of the test.
+    async def create():
+        engine = create_async_engine(db_url)
+        async with engine.begin() as connection:
+            await connection.run_sync(tables.Base.metadata.create_all)
+        return engine
+    return create
@@ -0,0 +1,64 @@
+import asyncio
+import json
+
+from tgdog.db import TGBotDBMixin, tables
+from tgdog.gui import TGBotGUIMixin
+from tgdog.gui.storage import STATE_VERSION, BlobStorage, get_state_columns
+
+
+class Window:
+
+    def __init__(self, state=None, state_version=None):
+        self.row = tables.Window(state=state, state_version=state_version)
+
+
+def test_state_is_json_and_round_trips():
+    storage = BlobStorage(Window())
+    rows = [
+        tables.SimpleButton(callback_data=b'\x00\xffdata', name='Кнопка', arg='1'),
+        tables.Text(tab_index=0, tab_id=1, header='Заголовок', body='Текст'),
+        tables.Tab(index_in_window=0, json_data={'key': [1, 'значение']}),
+    ]
+    storage.rows = {id(row): row for row in rows}
+    storage.save_state()
+    state = storage.window.row.state
+    assert json.loads(state)
+    assert storage.window.row.state_version == STATE_VERSION
+    loaded_storage = BlobStorage(Window(state, STATE_VERSION))
+    loaded_storage.load_state()
+    loaded_rows = list(loaded_storage.rows.values())
+    assert [type(row) for row in loaded_rows] == [type(row) for row in rows]
+    for row, loaded_row in zip(rows, loaded_rows):
+        for key in get_state_columns(type(row)):
+            assert getattr(loaded_row, key) == getattr(row, key)
+
+
+class Storage:
+
+    def __init__(self):
+        self.saved = False
+
+    def save_state(self):
+        self.saved = True
+
+
+def test_states_are_saved_by_own_sessions_only(make_controller, db_url):
+    async def commit(controller):
+        storage = Storage()
+        async with controller.session() as session:
+            session.sync_session.info['window_storages'] = {storage}
+            await session.commit()
+        return storage.saved
+
+    async def main():
+        controllers = [make_controller(TGBotDBMixin, TGBotGUIMixin, db_url=db_url, host=None) for i in range(2)]
+        for controller in controllers:
+            await controller.init_db()
+        controllers[0].listen_window_events()
+        saved = [await commit(controller) for controller in controllers]
+        controllers[0].remove_window_events()
+        saved.append(await commit(controllers[0]))
+        for controller in controllers:
+            await controller.close_db()
+        return saved
+    assert asyncio.run(main()) == [True, False, False]
@@ -0,0 +1,54 @@
+import asyncio
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import sessionmaker
+
+from tgdog.db import tables
+from tgdog.messages import TGBotMessagesMixin
+
+SEND_DELAY = 0.05
+
+
+class App:
+
+    def __init__(self):
+        self.sent_chat_ids = []
+
+    async def send_message(self, chat_id, text, *args, limiters, previous_invoke_event, current_invoke_event, **kwargs):
+        await asyncio.sleep(SEND_DELAY)
+        self.sent_chat_ids.append(chat_id)
+        return object()
+
+
+def test_cancelled_broadcast_is_resumed_without_duplicates(make_controller, create_engine):
+    async def main():
+        engine = await create_engine()
+        controller = make_controller(
+            TGBotMessagesMixin,
+            session=sessionmaker(engine, class_=AsyncSession, expire_on_commit=False),
+            app=App(),
+        )
+        async with controller.session() as session:
+            session.add_all([tables.User(user_id=user_id) for user_id in range(1, 11)])
+            await session.commit()
+        sender = asyncio.create_task(controller.message_sender(1))
+        query = select(tables.User.user_id)
+        broadcast = asyncio.create_task(controller.broadcast('text', query, name='test'))
+        # The third message is being sent, the rest are queued.
+        while len(controller.app.sent_chat_ids) < 2:
+            await asyncio.sleep(SEND_DELAY / 10)
+        broadcast.cancel()
+        await asyncio.gather(broadcast, return_exceptions=True)
+        await asyncio.sleep(SEND_DELAY * 3)
+        sent_before_resume = list(controller.app.sent_chat_ids)
+        result = await controller.broadcast('text', query, name='test')
+        sender.cancel()
+        await asyncio.gather(sender, return_exceptions=True)
+        await engine.dispose()
+        return sent_before_resume, controller.app.sent_chat_ids, result
+    sent_before_resume, sent_chat_ids, result = asyncio.run(main())
+    # The message being sent at the cancellation is delivered, the queued ones are not.
+    assert sent_before_resume in ([1, 2], [1, 2, 3])
+    assert sent_chat_ids == list(range(1, 11))
+    assert result == {'sent': 10, 'failed': 0, 'blocked': 0}
@@ -0,0 +1,95 @@
+import asyncio
+
+import pyrogram
+from pyrogram.raw.types import PeerUser, UpdateBotCallbackQuery
+
+from tgdog.enums import Category
+from tgdog.wrappers.dispatcher import Dispatcher
+
+
+class Client:
+
+    def __init__(self, controller):
+        self.controller = controller
+
+
+class CallbackQuery:
+
+    def __init__(self, data):
+        self.data = data
+
+
+def get_packet(data):
+    update = UpdateBotCallbackQuery(
+        query_id=1,
+        user_id=1,
+        peer=PeerUser(user_id=1),
+        msg_id=1,
+        chat_instance=1,
+        data=data,
+    )
+    return update, {}, {}
+
+
+async def parse_callback_query(update, users, chats):
+    return CallbackQuery(update.data), pyrogram.handlers.CallbackQueryHandler
+
+
+async def handle(dispatcher, packet):
+    dispatcher.updates_queue.put_nowait(packet)
+    dispatcher.updates_queue.put_nowait(None)
+    await dispatcher.handler_worker(None)
+
+
+def add_recording_handlers(dispatcher, calls, handler_class):
+    for category in Category:
+        async def callback(*args, category=category):
+            calls.append(category)
+        dispatcher.update_handlers(added=[(handler_class(callback), category, 0)])
+
+
+def test_parse_error_is_finalized(make_controller):
+    async def main():
+        dispatcher = Dispatcher(Client(make_controller(worker_per_chat=False)))
+
+        async def parse(update, users, chats):
+            raise pyrogram.errors.MessageIdInvalid()
+        dispatcher.update_parsers[UpdateBotCallbackQuery] = parse
+        calls = []
+        add_recording_handlers(dispatcher, calls, pyrogram.handlers.RawUpdateHandler)
+        await dispatcher.add_handler(pyrogram.handlers.CallbackQueryHandler(lambda *args: None), Category.MAIN, 1)
+        await handle(dispatcher, get_packet(b'data'))
+        return calls
+    # The raw handler of MAIN runs before the parse fails.
+    assert asyncio.run(main()) == [Category.INITIALIZE, Category.MAIN, Category.RESTORE, Category.FINALIZE]
+
+
+def test_route_resolver_error_is_finalized(make_controller):
+    async def main():
+        dispatcher = Dispatcher(Client(make_controller(worker_per_chat=False)))
+        dispatcher.update_parsers[UpdateBotCallbackQuery] = parse_callback_query
+        calls = []
+        add_recording_handlers(dispatcher, calls, pyrogram.handlers.CallbackQueryHandler)
+
+        def resolve(data):
+            raise ValueError('Bad callback data')
+        await dispatcher.add_callback_query_route('route:', lambda *args: calls.append('route'), resolve)
+        await handle(dispatcher, get_packet(b'route:x'))
+        return calls
+    assert asyncio.run(main()) == [Category.INITIALIZE, Category.RESTORE, Category.FINALIZE]
+
+
+def test_prefilter_error_affects_only_its_update(make_controller):
+    async def main():
+        dispatcher = Dispatcher(Client(make_controller(worker_per_chat=False)))
+
+        def prefilter(update, users, chats):
+            if update.data == b'broken':
+                raise ValueError('Broken prefilter')
+            return update.data != b'dropped'
+        dispatcher.add_prefilter(prefilter)
+        for data in [b'broken', b'dropped', b'data']:
+            dispatcher.updates_queue.put_nowait(get_packet(data))
+        queue = dispatcher.updates_queue
+        return [queue.get_nowait().update.data for i in range(queue.qsize())]
+    assert asyncio.run(main()) == [b'broken', b'data']
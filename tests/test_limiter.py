@@ -0,0 +1,23 @@
+import asyncio
+import time
+
+from tgdog.limiter import Limiter
+
+PERIOD = 0.2
+
+
+def test_no_window_of_one_period_exceeds_amount(make_controller):
+    async def main():
+        limiter = Limiter(make_controller(), 5, PERIOD)
+        times = []
+
+        async def wait():
+            await limiter()
+            times.append(time.monotonic())
+        await asyncio.gather(*[wait() for i in range(12)])
+        return times
+    times = sorted(asyncio.run(main()))
+    for i, t in enumerate(times):
+        # Small tolerance for the timer resolution.
+        assert sum(1 for other in times[i:] if other < t + PERIOD - 0.002) <= 5
+    assert times[-1] - times[0] >= PERIOD * 2 - 0.002
@@ -0,0 +1,101 @@
+import asyncio
+from collections import OrderedDict
+import json
+
+from sqlalchemy import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import sessionmaker
+
+from tgdog.db import tables
+from tgdog.helpers.fair_queue import FairQueue
+from tgdog.message_spool import MessageSpool
+from tgdog.messages import QueuedMessage
+
+CHAT_ID = 1
+PRIORITY = 2
+
+
+class InterleavingSession(AsyncSession):
+    # Runs the hook while the statement is being executed, as another task would.
+    hook = None
+
+    async def execute(self, *args, **kwargs):
+        hook, InterleavingSession.hook = InterleavingSession.hook, None
+        if hook is not None:
+            hook()
+        return await super().execute(*args, **kwargs)
+
+
+class SpoolController:
+    # The part of TGBotMessagesMixin the spool works with.
+
+    def __init__(self):
+        self.message_queues = OrderedDict((priority, FairQueue()) for priority in range(1, 4))
+        self.message_id = 1
+
+    def enqueue_message(self, message):
+        self.message_queues[message.priority].append(message.chat_id, message)
+
+    def put(self, spool, text):
+        message = QueuedMessage(CHAT_ID, text, (), {}, PRIORITY, self.message_id)
+        self.message_id += 1
+        assert spool.put(message)
+
+    def get_texts(self, priority):
+        queue = self.message_queues[priority]
+        texts = []
+        while queue.ready:
+            texts.append(queue.popleft().text)
+            queue.release(CHAT_ID)
+        return texts
+
+
+def test_put_during_load_is_not_lost(make_controller, create_engine):
+    async def main():
+        engine = await create_engine()
+        controller = make_controller(
+            SpoolController,
+            session=sessionmaker(engine, class_=InterleavingSession, expire_on_commit=False),
+        )
+        spool = MessageSpool(controller, 10)
+        controller.put(spool, 'before')
+        async with controller.session() as session:
+            await spool.count_spilled_messages(session)
+        spool.replaying = False
+        await spool.write()
+        # The message spills, because the counter is not zero yet, and is inserted by the next write.
+        InterleavingSession.hook = lambda: controller.put(spool, 'during')
+        async with controller.session() as session:
+            await spool.load_spilled_messages(session)
+        controller.put(spool, 'after')
+        await spool.flush()
+        texts = controller.get_texts(PRIORITY)
+        await engine.dispose()
+        return texts
+    assert asyncio.run(main()) == ['before', 'during', 'after']
+
+
+def test_messages_of_previous_run_are_replayed_without_new_sends(make_controller, create_engine):
+    async def main():
+        engine = await create_engine()
+        controller = make_controller(
+            SpoolController,
+            session=sessionmaker(engine, class_=AsyncSession, expire_on_commit=False),
+        )
+        async with controller.session() as session, session.begin():
+            await session.execute(insert(tables.SpooledMessage), [
+                {'chat_id': CHAT_ID, 'priority': PRIORITY, 'text': text, 'data': json.dumps([[], {}])}
+                for text in ('first', 'second', 'third')
+            ])
+        spool = MessageSpool(controller, 10)
+        worker = asyncio.create_task(spool.worker())
+        for i in range(100):
+            if len(controller.message_queues[PRIORITY]) == 3:
+                break
+            await asyncio.sleep(0.01)
+        worker.cancel()
+        await asyncio.gather(worker, return_exceptions=True)
+        texts = controller.get_texts(PRIORITY)
+        await engine.dispose()
+        return texts
+    assert asyncio.run(main()) == ['first', 'second', 'third']
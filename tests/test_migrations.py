@@ -0,0 +1,86 @@
+import importlib.util
+import os
+import re
+
+from alembic.migration import MigrationContext
+from alembic.operations import Operations
+from sqlalchemy import create_engine, desc, inspect, or_, select
+
+from tgdog.constants import DEFAULT_USER_ID
+from tgdog.db import MIGRATIONS_DIRECTORY, tables
+
+REVISIONS = [
+    '031af6865913_add_lookup_indexes',
+    '5b2e0c7d9a41_add_window_state',
+    '8c1f4a2b6d37_add_message_tables',
+]
+MESSAGE_TABLES = {'spooled_message', 'broadcast'}
+
+
+def load_revision(name):
+    spec = importlib.util.spec_from_file_location(name, os.path.join(MIGRATIONS_DIRECTORY, f'{name}.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def get_lookups():
+    # The statements are the same as the ones the bot executes.
+    lookups = [
+        ('ix_user_user_id', select(tables.User).where(tables.User.user_id == 1)),
+        ('ix_window_chat_id_input_required_user_id_id', select(tables.Window).where(
+            tables.Window.chat_id == 1,
+            or_(tables.Window.user_id == DEFAULT_USER_ID, tables.Window.user_id == 1),
+            tables.Window.input_required == True,
+        ).order_by(desc(tables.Window.id))),
+        ('ix_text_window_id_tab_index_tab_id', select(tables.Text).where(
+            tables.Text.window_id == 1,
+            tables.Text.tab_index == 0,
+            tables.Text.tab_id == 1,
+        )),
+        ('ix_pyrogram_button_window_id_tab_index', select(tables.PyrogramButton).where(
+            tables.PyrogramButton.window_id == 1,
+            tables.PyrogramButton.tab_index == 0,
+        )),
+    ]
+    for table in (tables.Tab, tables.TimeZoneSelectionTab, tables.NumberSelectionTab):
+        lookups.append((f'ix_{table.__tablename__}_window_id_index_in_window', select(table).where(
+            table.window_id == 1,
+            table.index_in_window == 0,
+        )))
+    for table in (tables.SimpleButton, tables.CheckBoxButton, tables.SingleSelectButton):
+        lookups.append((f'ix_{table.__tablename__}_window_id', select(table).where(table.window_id == 1)))
+    return lookups
+
+
+def get_plan(connection, stmt):
+    sql = str(stmt.compile(connection, compile_kwargs={'literal_binds': True}))
+    return ' '.join(row[-1] for row in connection.exec_driver_sql(f'EXPLAIN QUERY PLAN {sql}'))
+
+
+def test_lookups_use_migration_indexes(tmp_path):
+    engine = create_engine(f'sqlite:///{tmp_path / "migrations.db"}')
+    revisions = [load_revision(name) for name in REVISIONS]
+    with engine.begin() as connection:
+        tables.Base.metadata.create_all(connection)
+        with Operations.context(MigrationContext.configure(connection)):
+            # The schema as it was before the migrations.
+            for revision in reversed(revisions):
+                revision.downgrade()
+            indexes = {
+                index['name']
+                for table in inspect(connection).get_table_names()
+                for index in inspect(connection).get_indexes(table)
+            }
+            assert not indexes & {name for name, stmt in get_lookups()}
+            assert not MESSAGE_TABLES & set(inspect(connection).get_table_names())
+            for revision in revisions:
+                revision.upgrade()
+            # Repeated upgrades skip what already exists.
+            for revision in revisions:
+                revision.upgrade()
+        assert MESSAGE_TABLES <= set(inspect(connection).get_table_names())
+        for name, stmt in get_lookups():
+            plan = get_plan(connection, stmt)
+            assert re.search(f'USING (COVERING )?INDEX {name}\\b', plan), plan
+    engine.dispose()
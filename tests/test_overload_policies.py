@@ -0,0 +1,61 @@
+import asyncio
+
+import pyrogram
+from pyrogram.raw.types import Message, PeerUser, UpdateBotCallbackQuery, UpdateNewMessage
+
+from tgdog.overload_policies import CollapseUserUpdates, DropStaleCallbackQueries
+from tgdog.wrappers.updates_queue import UpdateEntry
+
+
+class Client:
+
+    def __init__(self, controller):
+        self.controller = controller
+        self.answered_query_ids = []
+
+    async def answer_callback_query(self, query_id, *args, **kwargs):
+        self.answered_query_ids.append(query_id)
+        raise pyrogram.errors.QueryIdInvalid()
+
+
+class Dispatcher:
+
+    def __init__(self, client):
+        self.client = client
+
+
+def get_callback_query_entry(query_id):
+    return UpdateEntry((UpdateBotCallbackQuery(
+        query_id=query_id,
+        user_id=1,
+        peer=PeerUser(user_id=1),
+        msg_id=1,
+        chat_instance=1,
+    ), {}, {}))
+
+
+def get_message_entry(message_id):
+    message = Message(id=message_id, peer_id=PeerUser(user_id=1), from_id=PeerUser(user_id=1), date=0, message='')
+    return UpdateEntry((UpdateNewMessage(message=message, pts=0, pts_count=0), {}, {}))
+
+
+def test_stale_callback_query_is_answered_without_errors(make_controller):
+    async def main():
+        # The controller has no add_task, the answer is a task of the policy itself.
+        dispatcher = Dispatcher(Client(make_controller()))
+        policy = DropStaleCallbackQueries(max_age=0)
+        assert not policy.accept(dispatcher, get_callback_query_entry(1))
+        await asyncio.gather(*policy.answer_tasks)
+        return dispatcher.client.answered_query_ids, policy.answer_tasks
+    answered_query_ids, answer_tasks = asyncio.run(main())
+    assert answered_query_ids == ['1']
+    assert not answer_tasks
+
+
+def test_new_messages_are_not_collapsed_by_default():
+    policy = CollapseUserUpdates()
+    dispatcher = Dispatcher(None)
+    entries = [get_message_entry(1), get_message_entry(2), get_callback_query_entry(1), get_callback_query_entry(2)]
+    for entry in entries:
+        policy.put(dispatcher, entry)
+    assert [policy.accept(dispatcher, entry) for entry in entries] == [True, True, False, True]
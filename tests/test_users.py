@@ -0,0 +1,57 @@
+import asyncio
+
+import sqlalchemy
+from sqlalchemy import event
+
+from tgdog.db import DBManager, TGBotDBMixin, tables
+from tgdog.users import TGBotUsersMixin
+
+
+def test_user_cache_is_invalidated_by_own_sessions_only(make_controller, db_url, create_engine):
+    async def start_controller():
+        controller = make_controller(
+            TGBotDBMixin,
+            TGBotUsersMixin,
+            db_url=db_url,
+            host=None,
+            User=tables.User,
+            user_cache_size=10,
+            user_cache_ttl=60,
+        )
+        await controller.init_db()
+        controller.listen_user_events()
+        return controller
+
+    async def stop_controller(controller):
+        controller.remove_user_events()
+        await controller.close_db()
+
+    async def main():
+        await (await create_engine()).dispose()
+        controller = await start_controller()
+        other_controller = await start_controller()
+        for c in (controller, other_controller):
+            async with DBManager(c):
+                await c.get_or_create_user(1)
+            async with DBManager(c):
+                await c.get_or_create_user(1)
+        async with DBManager(controller):
+            user = await controller.get_or_create_user(1)
+            user.user_id = 2
+        listening = (
+            event.contains(controller.sync_session_class, 'after_flush', controller.on_flush)
+            and event.contains(controller.sync_session_class, 'after_commit', controller.on_commit)
+            and not event.contains(sqlalchemy.orm.Session, 'after_commit', controller.on_commit)
+        )
+        stats = controller.user_cache.stats, other_controller.user_cache.stats
+        await stop_controller(controller)
+        await stop_controller(other_controller)
+        removed = not (
+            event.contains(controller.sync_session_class, 'after_flush', controller.on_flush)
+            or event.contains(controller.sync_session_class, 'after_commit', controller.on_commit)
+        )
+        return listening, removed, stats
+    listening, removed, (stats, other_stats) = asyncio.run(main())
+    assert listening and removed
+    assert stats['size'] == 0 and stats['invalidations'] == 1
+    assert other_stats['size'] == 1 and other_stats['invalidations'] == 0
@@ -1 +1,2 @@
 from tgdog.bot import BotController
+from tgdog.host import BotHost
@@ -17,11 +17,14 @@ except ImportError:
 from tgdog import (
     db,
     exception_handler,
+    multiprocess,
 )
 from tgdog.core import TGBotCoreMixin
-from tgdog.enums import QuoteReplyMode
+from tgdog.enums import Category, QuoteReplyMode
 from tgdog.handler_decorators import get_handlers
-from tgdog.gui import TGBotGUIMixin
+from tgdog.logging_helpers import WarningErrorHandler
+from tgdog.gui import TGBotGUIMixin, WindowCache
+from tgdog.message_spool import MessageSpool
 from tgdog.messages import TGBotMessagesMixin
 from tgdog.users import TGBotUsersMixin
 from tgdog.wrappers import apply_wrappers, name_inflection
@@ -37,21 +40,52 @@ class BotController(
     TGBotUsersMixin,
 ):
 
+    def __new__(cls, *args, **kwargs):
+        self = super().__new__(cls)
+        # Worker processes create the controller again with the same arguments.
+        self.init_args = args
+        self.init_kwargs = kwargs
+        return self
+
     def __init__(
         self,
         bot_name,
         use_uvloop=False,
         worker_per_chat=False,
+        chat_queues=False,
+        updates_queue_watermark=None,
+        overload_policies=(),
         username_inflection=False,
         user_table=None,
-        quote_reply_mode=QuoteReplyMode.PYROGRAM
+        user_cache_size=0,
+        user_cache_ttl=60,
+        quote_reply_mode=QuoteReplyMode.PYROGRAM,
+        idle_resources_ttl=600,
+        idle_resources_sweep_interval=60,
+        message_spool=False,
+        message_spool_watermark=10000,
+        window_cache_size=0,
+        window_cache_flush_interval=1,
+        processes=1,
+        host=None,
+        session_name='telegram_account',
+        api_id=None,
+        api_hash=None,
+        bot_token=None,
+        db_url=None,
+        dev_ids=None,
     ):
-        for var in ['api_id', 'api_hash', 'bot_token', 'db_url', 'dev_ids']:
-            setattr(self, var, os.getenv(var.upper()))
+        # Credentials passed explicitly take precedence over the environment, so several bots can share a process.
+        credentials = {'api_id': api_id, 'api_hash': api_hash, 'bot_token': bot_token, 'db_url': db_url, 'dev_ids': dev_ids}
+        for var, value in credentials.items():
+            setattr(self, var, value or os.getenv(var.upper()))
             if not getattr(self, var):
                 raise RuntimeError(f'"{var.upper()}" environment variable not specified')
-        self.dev_ids = [int(i) for i in self.dev_ids.split(',')]
+        if isinstance(self.dev_ids, str):
+            self.dev_ids = self.dev_ids.split(',')
+        self.dev_ids = [int(i) for i in self.dev_ids]
         self.bot_name = bot_name
+        self.session_name = session_name
         self.app = None
         apply_wrappers()
         if sys.platform != 'win32' and use_uvloop:
@@ -60,23 +94,61 @@ class BotController(
             else:
                 uvloop.install()
         self.worker_per_chat = worker_per_chat
+        # Per-chat ordering through per-chat queues instead of chat locks.
+        self.chat_queues = chat_queues
+        # Once the watermark is reached, the policies from tgdog.overload_policies decide which updates to drop.
+        self.updates_queue_watermark = updates_queue_watermark
+        self.overload_policies = overload_policies
         self.User = user_table or db.tables.User
+        # Users are cached between updates, rows changed by other processes or bots are seen only after user_cache_ttl seconds.
+        self.user_cache_size = user_cache_size
+        self.user_cache_ttl = user_cache_ttl
         self.quote_reply_mode = quote_reply_mode
         self.username_inflection = username_inflection
+        self.idle_resources_ttl = idle_resources_ttl
+        self.idle_resources_sweep_interval = idle_resources_sweep_interval
         if self.username_inflection and pymorphy3 is None:
             raise ValueError('pymorphy3 is not installed')
+        # With several processes the main one only keeps the connection to telegram,
+        # updates are handled by worker processes, each of them gets its own set of chats.
+        self.processes = processes
+        self.worker_index = None
+        self.main_process_socket = None
+        if self.processes > 1 and message_spool:
+            raise ValueError('Message spool cannot be used with several processes')
+        if self.processes > 1 and user_cache_size:
+            raise ValueError('User cache cannot be used with several processes')
+        # The host shares the event loop, database engines and log handlers between its bots.
+        self.host = host
+        if self.host is not None:
+            self.host.add_bot(self)
         super().__init__()
+        if message_spool:
+            self.message_spool = MessageSpool(self, message_spool_watermark)
+        # Live windows are kept between callback queries and written to the database in batches,
+        # changes of the last window_cache_flush_interval seconds can be lost on a crash.
+        if window_cache_size:
+            self.window_cache = WindowCache(self, window_cache_size, window_cache_flush_interval)
 
     def get_global_filter(self):
         pass
 
+    def get_prefilter(self):
+        # Unlike the global filter, works with raw updates: prefilter(update, users, chats) -> bool.
+        pass
+
     async def initialize(self):
         if self.username_inflection:
             await asyncio.to_thread(name_inflection.NameWord.initialize_morph)
         self.app.controller = self
         exception_handler.wrap_methods(self)
         global_filter = self.get_global_filter()
-        for handler in get_handlers():
+        prefilter = self.get_prefilter()
+        if prefilter is not None:
+            self.app.dispatcher.add_prefilter(prefilter)
+        handlers = []
+        routes = []
+        for handler in get_handlers(type(self)):
             filters = None
             if handler['handler_args']:
                 filters = handler['handler_args'][0]
@@ -89,11 +161,22 @@ class BotController(
                 else:
                     filters = global_filter & filters
             method = getattr(self, handler['handler_name'])
-            await self.app.dispatcher.add_handler(
+            if 'callback_data_prefix' in handler['handler_kwargs']:
+                routes.append((
+                    handler['handler_kwargs']['callback_data_prefix'],
+                    handler['handler'](method, filters=filters),
+                    handler['handler_kwargs'].get('callback_data_resolver'),
+                ))
+                continue
+            handlers.append((
                 handler['handler'](method, filters=filters),
-                **handler['handler_kwargs']
-            )
+                handler['handler_kwargs'].get('category', Category.MAIN),
+                handler['handler_kwargs'].get('group', 0),
+            ))
+        self.app.dispatcher.update_handlers(added=handlers, added_routes=routes)
         await self.init_db()
+        self.listen_user_events()
+        self.listen_window_events()
 
     async def initialize_bot(self):
         pass
@@ -101,13 +184,9 @@ class BotController(
     async def terminate(self):
         pass
 
-    async def start(self):
-        try:
-            asyncio.get_running_loop().add_signal_handler(signal.SIGINT, self.stop_from_signal)
-        except NotImplementedError:
-            signal.signal(signal.SIGINT, self.stop_from_signal)
-        self.app = pyrogram.Client(
-            'telegram_account',
+    def create_client(self, client_class=pyrogram.Client):
+        return client_class(
+            self.session_name,
             api_id=self.api_id,
             api_hash=self.api_hash,
             bot_token=self.bot_token,
@@ -115,10 +194,76 @@ class BotController(
             sleep_threshold=0,
             parse_mode=pyrogram.enums.ParseMode.HTML,
         )
+
+    async def connect_to_main_process(self):
+        self.app = self.create_client(multiprocess.ProxyClient)
+        connection = multiprocess.MainProcessConnection(self, self.main_process_socket)
+        await connection.open()
+        self.app.main_process_connection = connection
+        # Logs are written by the main process, only notifications of the developers are sent from here.
+        for handler in list(self.log.handlers):
+            if not isinstance(handler, WarningErrorHandler):
+                self.log.removeHandler(handler)
+        self.log.addHandler(multiprocess.ProcessLogHandler(connection))
+        # All processes share one bot, so they share its global limit too.
+        limiter = self.global_message_limiter
+        limiter.resize(max(1, limiter.amount // self.processes))
+        self.add_task(connection.serve, name='main_process_connection')
+        self.log.info(f'Рабочий процесс {self.worker_index} запущен')
+
+    async def start_main_process(self):
+        connections, processes = multiprocess.start_worker_processes(self)
+        for connection in connections:
+            await connection.open()
+        self.app = self.create_client()
+        self.app.controller = self
+        # Requests of the workers are performed as is, errors are handled by the workers.
+        self.raw_invoke = self.app.invoke
+        self.raw_resolve_peer = self.app.resolve_peer
+        exception_handler.wrap_methods(self)
+        self.app.dispatcher.updates_queue = multiprocess.ForwardingQueue(connections)
+        for connection in connections:
+            self.add_task(connection.serve, name=f'worker_connection_{connection.index}')
+        await self.app.start()
+        self.add_task(self.message_sender, 23)
+        self.log.info(f'Приложение запущено, рабочих процессов: {len(processes)}')
+        try:
+            await self.monitor_tasks()
+        finally:
+            print('\r', end='')  # To remove C character from terminal
+            self.log.info('Выход')
+            await self.app.stop()
+            for connection in connections:
+                await connection.close()
+            for process in processes:
+                await asyncio.to_thread(process.join)
+            [task.cancel() for task in self.async_tasks if task.cancellable]
+
+    async def start(self):
+        if self.host is None:
+            try:
+                asyncio.get_running_loop().add_signal_handler(signal.SIGINT, self.stop_from_signal)
+            except NotImplementedError:
+                signal.signal(signal.SIGINT, self.stop_from_signal)
+        if self.processes == 1:
+            self.app = self.create_client()
+        elif self.worker_index is None:
+            return await self.start_main_process()
+        else:
+            await self.connect_to_main_process()
         await self.initialize()
         await self.app.start()
         await self.initialize_bot()
+        if self.message_spool:
+            self.add_task(self.message_spool.worker, name='message_spool')
+        if self.window_cache:
+            self.add_task(self.window_cache.worker, name='window_cache')
         self.add_task(self.message_sender, 23)
+        self.add_task(
+            self.idle_resources_sweeper,
+            self.idle_resources_sweep_interval,
+            self.idle_resources_ttl,
+        )
         self.log.info('Приложение запущено')
         try:
             await self.monitor_tasks()
@@ -127,6 +272,12 @@ class BotController(
             self.log.info('Выход')
             await self.terminate()
             await self.app.stop()
+            if self.message_spool:
+                await self.message_spool.close()
+            if self.window_cache:
+                await self.window_cache.close()
+            self.remove_window_events()
+            self.remove_user_events()
             await self.close_db()
             [task.cancel() for task in self.async_tasks if task.cancellable]
 
@@ -135,4 +286,5 @@ class BotController(
 
     def stop(self):
         self.canceling = True
-        self.monitor_task.cancel()
+        if self.monitor_task:
+            self.monitor_task.cancel()
@@ -20,6 +20,43 @@ def log_record_factory(*args, **kwargs):
     return record
 
 
+DETAILED_LOG_FORMAT = (
+    '%(asctime)s - %(levelname)s - %(module)s'
+    '.%(funcName)s (%(lineno)d) | %(username)s\n%(message)s'
+)
+
+
+def create_log_handlers(show_logger_name=False):
+    # With several bots in one process the records are written to the same files, so they are marked with the bot name.
+    console_format = '%(message)s'
+    detailed_format = DETAILED_LOG_FORMAT
+    if show_logger_name:
+        console_format = '%(name)s: ' + console_format
+        detailed_format = '%(name)s | ' + detailed_format
+    console_handler = logging.StreamHandler()
+    console_handler.setLevel(logging.INFO)
+    console_handler.setFormatter(logging.Formatter(console_format))
+    file_handler = logging.handlers.RotatingFileHandler(
+        'log.log',
+        encoding='utf-8',
+        maxBytes=LOG_MAX_SIZE,
+        backupCount=LOG_MAX_BACKUPS
+    )
+    file_handler.setLevel(logging.DEBUG)
+    detailed_formatter = Formatter(detailed_format)
+    file_handler.setFormatter(detailed_formatter)
+    file_error_handler = logging.handlers.RotatingFileHandler(
+        'error.log',
+        encoding='utf-8',
+        maxBytes=LOG_MAX_SIZE,
+        backupCount=LOG_MAX_BACKUPS,
+        delay=True
+    )
+    file_error_handler.setLevel(logging.ERROR)
+    file_error_handler.setFormatter(detailed_formatter)
+    return [console_handler, file_handler, file_error_handler]
+
+
 class TGBotCoreMixin:
 
     def __init__(self):
@@ -29,35 +66,15 @@ class TGBotCoreMixin:
         logging.setLogRecordFactory(log_record_factory)
         self.log = logging.getLogger(self.bot_name)
         self.log.setLevel(logging.DEBUG)
-        console_handler = logging.StreamHandler()
-        console_handler.setLevel(logging.INFO)
-        console_handler.setFormatter(logging.Formatter('%(message)s'))
-        self.log.addHandler(console_handler)
-        file_handler = logging.handlers.RotatingFileHandler(
-            'log.log',
-            encoding='utf-8',
-            maxBytes=LOG_MAX_SIZE,
-            backupCount=LOG_MAX_BACKUPS
-        )
-        file_handler.setLevel(logging.DEBUG)
-        detailed_formatter = Formatter(
-            '%(asctime)s - %(levelname)s - %(module)s'
-            '.%(funcName)s (%(lineno)d) | %(username)s\n%(message)s'
-        )
-        file_handler.setFormatter(detailed_formatter)
-        self.log.addHandler(file_handler)
-        file_error_handler = logging.handlers.RotatingFileHandler(
-            'error.log',
-            encoding='utf-8',
-            maxBytes=LOG_MAX_SIZE,
-            backupCount=LOG_MAX_BACKUPS,
-            delay=True
-        )
-        file_error_handler.setLevel(logging.ERROR)
-        file_error_handler.setFormatter(detailed_formatter)
-        self.log.addHandler(file_error_handler)
+        if self.host is not None:
+            log_handlers = self.host.log_handlers
+        else:
+            log_handlers = create_log_handlers()
+        for handler in log_handlers:
+            self.log.addHandler(handler)
+        # Developers are notified by each bot separately.
         warning_error_handler = WarningErrorHandler(self)
-        warning_error_handler.setFormatter(detailed_formatter)
+        warning_error_handler.setFormatter(Formatter(DETAILED_LOG_FORMAT))
         self.log.addHandler(warning_error_handler)
         super().__init__()
 
@@ -13,25 +13,88 @@ from tgdog.handler_decorators import on_callback_query, on_message
 from tgdog.helpers import ContextVarWrapper
 
 db = ContextVarWrapper('db')
+# Add to version_locations of the application's alembic configuration, the revisions have the "tgdog" branch label.
+MIGRATIONS_DIRECTORY = os.path.join(os.path.dirname(__file__), 'migrations', 'versions')
+
+
+class LazySession:
+    # Stands in for AsyncSession in the db context var, the session itself is created on first use,
+    # so commit, rollback and close cost nothing for updates that never touched the database.
+    __slots__ = ('session_factory', 'session', 'access_to_context_var_value_restricted')
+
+    def __init__(self, session_factory):
+        self.session_factory = session_factory
+        self.session = None
+
+    @property
+    def is_materialized(self):
+        return self.session is not None
+
+    def get_session(self):
+        if self.session is None:
+            self.session = self.session_factory()
+        return self.session
+
+    async def commit(self):
+        if self.session is not None:
+            await self.session.commit()
+
+    async def rollback(self):
+        if self.session is not None:
+            await self.session.rollback()
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+
+    def __getattr__(self, name):
+        # Own attributes that are not set yet (the restriction flag in particular) must not create the session.
+        if name in LazySession.__slots__:
+            raise AttributeError(name)
+        return getattr(self.get_session(), name)
+
+    def __setattr__(self, name, value):
+        if name in LazySession.__slots__:
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self.get_session(), name, value)
+
+
+def create_db_engine(db_url):
+    return create_async_engine(
+        db_url,
+        # echo=True,
+    )
 
 
 class TGBotDBMixin:
 
     async def init_db(self):
-        self.db_engine = create_async_engine(
-            self.db_url,
-            # echo=True,
+        if self.host is not None:
+            # Bots of one host with the same database share the engine and its connection pool.
+            self.db_engine = self.host.get_db_engine(self.db_url)
+        else:
+            self.db_engine = create_db_engine(self.db_url)
+        # Session events of one controller are listened on its own class, so they do not reach other controllers.
+        self.sync_session_class = type('Session', (sqlalchemy.orm.Session,), {})
+        async_session = sessionmaker(
+            self.db_engine,
+            class_=AsyncSession,
+            sync_session_class=self.sync_session_class,
+            expire_on_commit=False,
         )
-        async_session = sessionmaker(self.db_engine, class_=AsyncSession, expire_on_commit=False)
         self.session = async_session
 
     async def close_db(self):
-        await self.db_engine.dispose()
+        if self.host is not None:
+            await self.host.release_db_engine(self.db_url)
+        else:
+            await self.db_engine.dispose()
 
     @on_message(category=Category.INITIALIZE, group=group_manager.CREATE_SESSION)
     @on_callback_query(category=Category.INITIALIZE, group=group_manager.CREATE_SESSION)
     async def create_session(self, update):
-        db.set_context_var_value(self.session())
+        db.set_context_var_value(LazySession(self.session))
 
     @on_message(category=Category.RESTORE, group=group_manager.ROLLBACK_SESSION)
     @on_callback_query(category=Category.RESTORE, group=group_manager.ROLLBACK_SESSION)
@@ -89,7 +152,7 @@ class DBManager:
         session = self.controller
         for element in path:
             session = getattr(session, element)
-        db.set_context_var_value(session())
+        db.set_context_var_value(LazySession(session))
 
     async def __aexit__(self, exc_type, exc, tb):
         # First we get the session and restrict access to it,
@@ -0,0 +1,62 @@
+"""Add indexes for user and gui lookups
+
+Revision ID: 031af6865913
+Revises:
+Create Date: 2026-10-18 13:40:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '031af6865913'
+down_revision = None
+branch_labels = ('tgdog',)
+depends_on = None
+
+# Tables of the applications that use TabMixin, TextMixin or button mixins get the same indexes from the models,
+# so they are created by the migrations of the applications.
+INDEXES = [
+    ('ix_user_user_id', 'user', ['user_id'], True),
+    ('ix_window_chat_id_input_required_user_id_id', 'window', ['chat_id', 'input_required', 'user_id', 'id'], False),
+    ('ix_tab_window_id_index_in_window', 'tab', ['window_id', 'index_in_window'], False),
+    ('ix_time_zone_selection_tab_window_id_index_in_window', 'time_zone_selection_tab', ['window_id', 'index_in_window'], False),
+    ('ix_number_selection_tab_window_id_index_in_window', 'number_selection_tab', ['window_id', 'index_in_window'], False),
+    ('ix_text_window_id_tab_index_tab_id', 'text', ['window_id', 'tab_index', 'tab_id'], False),
+    ('ix_pyrogram_button_window_id_tab_index', 'pyrogram_button', ['window_id', 'tab_index'], False),
+    ('ix_simple_button_window_id', 'simple_button', ['window_id'], False),
+    ('ix_check_box_button_window_id', 'check_box_button', ['window_id'], False),
+    ('ix_single_select_button_window_id', 'single_select_button', ['window_id'], False),
+]
+
+
+def get_existing_indexes():
+    # The indexes may already be created by an autogenerated migration of the application.
+    inspector = sa.inspect(op.get_bind())
+    tables = set(inspector.get_table_names())
+    existing_indexes = set()
+    for table in tables:
+        existing_indexes.update((table, index['name']) for index in inspector.get_indexes(table))
+    return tables, existing_indexes
+
+
+def upgrade():
+    tables, existing_indexes = get_existing_indexes()
+    for name, table, columns, unique in INDEXES:
+        if table not in tables or (table, name) in existing_indexes:
+            continue
+        if unique:
+            column = sa.column(columns[0])
+            duplicates = op.get_bind().execute(
+                sa.select(column).select_from(sa.table(table)).group_by(column).having(sa.func.count() > 1).limit(1)
+            ).first()
+            if duplicates is not None:
+                raise RuntimeError(f'Table "{table}" contains duplicate values of {columns[0]}, for example {duplicates[0]}, they have to be removed before the upgrade')
+        op.create_index(name, table, columns, unique=unique)
+
+
+def downgrade():
+    tables, existing_indexes = get_existing_indexes()
+    for name, table, columns, unique in reversed(INDEXES):
+        if (table, name) in existing_indexes:
+            op.drop_index(name, table_name=table)
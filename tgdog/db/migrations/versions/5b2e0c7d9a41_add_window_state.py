@@ -0,0 +1,41 @@
+"""Add window state for blob storage
+
+Revision ID: 5b2e0c7d9a41
+Revises: 031af6865913
+Create Date: 2026-10-18 15:10:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '5b2e0c7d9a41'
+down_revision = '031af6865913'
+branch_labels = None
+depends_on = None
+
+COLUMNS = [
+    ('state', sa.LargeBinary()),
+    ('state_version', sa.Integer()),
+]
+
+
+def get_existing_columns():
+    # The columns may already be created by an autogenerated migration of the application.
+    inspector = sa.inspect(op.get_bind())
+    return {column['name'] for column in inspector.get_columns('window')}
+
+
+def upgrade():
+    existing_columns = get_existing_columns()
+    for name, type in COLUMNS:
+        if name not in existing_columns:
+            op.add_column('window', sa.Column(name, type, nullable=True))
+
+
+def downgrade():
+    existing_columns = get_existing_columns()
+    with op.batch_alter_table('window') as batch_op:
+        for name, type in reversed(COLUMNS):
+            if name in existing_columns:
+                batch_op.drop_column(name)
@@ -0,0 +1,57 @@
+"""Add spooled message and broadcast tables
+
+Revision ID: 8c1f4a2b6d37
+Revises: 5b2e0c7d9a41
+Create Date: 2026-10-18 18:20:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '8c1f4a2b6d37'
+down_revision = '5b2e0c7d9a41'
+branch_labels = None
+depends_on = None
+
+TABLES = ['spooled_message', 'broadcast']
+
+
+def get_existing_tables():
+    # The tables may already be created by an autogenerated migration of the application.
+    return set(sa.inspect(op.get_bind()).get_table_names())
+
+
+def upgrade():
+    existing_tables = get_existing_tables()
+    if 'spooled_message' not in existing_tables:
+        op.create_table(
+            'spooled_message',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('chat_id', sa.BigInteger(), nullable=False),
+            sa.Column('priority', sa.Integer(), nullable=False),
+            sa.Column('text', sa.String(), nullable=False),
+            sa.Column('data', sa.String(), nullable=False),
+            sa.PrimaryKeyConstraint('id'),
+        )
+        op.create_index('ix_spooled_message_priority_id', 'spooled_message', ['priority', 'id'])
+    if 'broadcast' not in existing_tables:
+        op.create_table(
+            'broadcast',
+            sa.Column('id', sa.Integer(), nullable=False),
+            sa.Column('name', sa.String(), nullable=False),
+            sa.Column('last_chat_id', sa.BigInteger(), nullable=True),
+            sa.Column('sent', sa.Integer(), nullable=False),
+            sa.Column('failed', sa.Integer(), nullable=False),
+            sa.Column('blocked', sa.Integer(), nullable=False),
+            sa.Column('finished', sa.Boolean(), nullable=False),
+            sa.PrimaryKeyConstraint('id'),
+            sa.UniqueConstraint('name'),
+        )
+
+
+def downgrade():
+    existing_tables = get_existing_tables()
+    for table in reversed(TABLES):
+        if table in existing_tables:
+            op.drop_table(table)
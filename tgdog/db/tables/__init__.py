@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer
+from sqlalchemy import Column, Index, Integer
 
 from tgdog.db.tables.base import Base
 from tgdog.db.tables.gui import (
@@ -12,9 +12,13 @@ from tgdog.db.tables.gui import (
     TimeZoneSelectionTab,
     Window,
 )
+from tgdog.db.tables.messages import Broadcast, SpooledMessage
 
 
 class User(Base):
     __tablename__ = 'user'
+    __table_args__ = (
+        Index('ix_user_user_id', 'user_id', unique=True),
+    )
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, nullable=False)
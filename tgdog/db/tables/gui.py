@@ -1,5 +1,5 @@
 import pyrogram
-from sqlalchemy import Boolean, Column, Integer, JSON, LargeBinary, String
+from sqlalchemy import Boolean, Column, Index, Integer, JSON, LargeBinary, String
 from sqlalchemy.ext.mutable import MutableList
 
 from tgdog.constants import DEFAULT_USER_ID
@@ -16,6 +16,10 @@ from tgdog.gui.mixins import (
 
 class Window(Base):
     __tablename__ = 'window'
+    __table_args__ = (
+        # Looking for a window waiting for input in TGBotGUIMixin.process_input.
+        Index('ix_window_chat_id_input_required_user_id_id', 'chat_id', 'input_required', 'user_id', 'id'),
+    )
     id = Column(Integer, primary_key=True)
     chat_id = Column(Integer, nullable=False)
     user_id = Column(Integer, nullable=False, default=DEFAULT_USER_ID)
@@ -24,6 +28,9 @@ class Window(Base):
     current_tab_index = Column(Integer)
     saved_tab_indexes = Column(MutableList.as_mutable(JSON), default=[])
     input_required = Column(Boolean, default=False)
+    # Tabs, texts and buttons of windows with BlobStorage.
+    state = Column(LargeBinary)
+    state_version = Column(Integer)
 
 
 class Tab(TabMixin, Base):
@@ -49,6 +56,9 @@ class Text(TextMixin, Base):
 
 class PyrogramButton(TableWithWindowMixin, Base):
     __tablename__ = 'pyrogram_button'
+    __table_args__ = (
+        Index('ix_pyrogram_button_window_id_tab_index', 'window_id', 'tab_index'),
+    )
     id = Column(Integer, primary_key=True)
     text = Column(String)
     callback_data = Column(LargeBinary(64))
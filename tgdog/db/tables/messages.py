@@ -0,0 +1,27 @@
+from sqlalchemy import BigInteger, Boolean, Column, Index, Integer, String
+
+from tgdog.db.tables.base import Base
+
+
+class SpooledMessage(Base):
+    __tablename__ = 'spooled_message'
+    __table_args__ = (
+        Index('ix_spooled_message_priority_id', 'priority', 'id'),
+    )
+    id = Column(Integer, primary_key=True)
+    chat_id = Column(BigInteger, nullable=False)
+    priority = Column(Integer, nullable=False)
+    text = Column(String, nullable=False)
+    # JSON encoded [args, kwargs] of the send_message call
+    data = Column(String, nullable=False)
+
+
+class Broadcast(Base):
+    __tablename__ = 'broadcast'
+    id = Column(Integer, primary_key=True)
+    name = Column(String, nullable=False, unique=True)
+    last_chat_id = Column(BigInteger)
+    sent = Column(Integer, nullable=False, default=0)
+    failed = Column(Integer, nullable=False, default=0)
+    blocked = Column(Integer, nullable=False, default=0)
+    finished = Column(Boolean, nullable=False, default=False)
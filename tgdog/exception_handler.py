@@ -105,6 +105,9 @@ def make_invoke_decorator(controller):
                 except pyrogram.errors.FloodWait as e:
                     exception = repr(e)
                     timeout = e.value
+                    # The whole lane is paused, so the limiters will hold this request along with the others.
+                    if any([limiter.report_flood_wait(timeout) for limiter in limiters]):
+                        timeout = 0
                 except (
                     OSError,
                     TimeoutError,
@@ -126,8 +129,11 @@ def make_invoke_decorator(controller):
                             raise MethodDecoratorException
                         return
                     raise AttemptLimitReached
-                log_func(msg+f'. Следующая попытка через {timeout} секунд')
-                await asyncio.sleep(timeout)
+                if timeout:
+                    log_func(msg+f'. Следующая попытка через {timeout} секунд')
+                    await asyncio.sleep(timeout)
+                else:
+                    log_func(msg+'. Следующая попытка после паузы лимитера')
         return wrapper
     return invoke_decorator
 
@@ -1,6 +1,8 @@
+import contextlib
+
 import pyrogram
 from pyrogram import filters
-from sqlalchemy import desc, or_, select
+from sqlalchemy import desc, event, or_, select
 
 from tgdog.constants import ANONYMOUS_USER_ID, DEFAULT_USER_ID
 from tgdog.db import db, tables
@@ -16,40 +18,90 @@ from tgdog.gui.exceptions import (
 )
 from tgdog.gui.input_fields import InputField
 from tgdog.gui.registry import window_registry
+from tgdog.gui.storage import BlobStorage, RelationalStorage, save_window_states
 from tgdog.gui.tabs import Tab
 from tgdog.gui.window import Window
+from tgdog.gui.window_cache import WindowCache
 from tgdog.handler_decorators import on_callback_query, on_message
 from tgdog.users import current_user
 
 
+def resolve_window_class(callback_data):
+    return (window_registry.get(callback_data[4:8], None),)
+
+
 class TGBotGUIMixin:
 
+    def __init__(self):
+        # Set by the controller when the cache of windows is turned on.
+        self.window_cache = None
+        super().__init__()
+
+    def listen_window_events(self):
+        # Blob states are saved only by the sessions of this controller.
+        event.listen(self.sync_session_class, 'before_commit', save_window_states)
+
+    def remove_window_events(self):
+        event.remove(self.sync_session_class, 'before_commit', save_window_states)
+
+    def lock_window(self, chat_id, window_id):
+        if self.window_cache is None:
+            return contextlib.nullcontext()
+        return self.window_cache.lock(chat_id, window_id)
+
+    async def get_window(self, window_class, chat_id, window_id, message=None, row=None):
+        # Must be called under lock_window.
+        if self.window_cache is not None and message is not None:
+            window = await self.window_cache.get(window_class, chat_id, window_id, message)
+            if window is not None:
+                return window
+        return await window_class.reconstruct(self, chat_id, window_id, message=message, row=row)
+
+    def cache_window(self, window):
+        if self.window_cache is not None:
+            self.window_cache.put(window)
+
+    def discard_cached_window(self, chat_id, window_id):
+        # The window could be changed by the failed update, its session will be rolled back.
+        if self.window_cache is not None:
+            self.window_cache.discard((chat_id, window_id))
+
     @on_callback_query(category=Category.INITIALIZE, group=group_manager.PROCESS_CALLBACK_QUERY)
     async def set_callback_query_context(self, callback_query):
         current_callback_query.set_context_var_value(callback_query)
 
-    @on_callback_query(group=group_manager.PROCESS_CALLBACK_QUERY)
-    async def handle_callback_query(self, callback_query):
-        if callback_query.data[:4] != CALLBACK_QUERY_SIGNATURE:
-            callback_query.continue_propagation()
+    # Only callback queries with the tgdog signature are routed here, the window class is already looked up by the dispatcher.
+    @on_callback_query(callback_data_prefix=CALLBACK_QUERY_SIGNATURE, callback_data_resolver=resolve_window_class)
+    async def handle_callback_query(self, callback_query, window_cls):
         try:
-            window_cls = window_registry.get(callback_query.data[4:8], None)
             if not window_cls:
                 raise NoWindowError
             window_id = int.from_bytes(callback_query.data[8:12], 'big')
-            try:
-                window = await window_cls.reconstruct(
-                    self,
-                    chat_id=callback_query.message.chat.id,
-                    window_id=window_id,
-                    message=callback_query.message
-                )
-                await window.handle_button_activation()
-            except StopUserRequestProcessing as e:
-                window = e.window
-                if e.alert is not None:
-                    await callback_query.answer(e.alert, show_alert=True)
-            await window.render()
+            chat_id = callback_query.message.chat.id
+            async with self.lock_window(chat_id, window_id):
+                window = None
+                try:
+                    try:
+                        window = await self.get_window(
+                            window_cls,
+                            chat_id=chat_id,
+                            window_id=window_id,
+                            message=callback_query.message
+                        )
+                        await window.handle_button_activation()
+                    except StopUserRequestProcessing as e:
+                        window = e.window
+                        if e.alert is not None:
+                            await callback_query.answer(e.alert, show_alert=True)
+                    await window.render()
+                except BaseException:
+                    if window is not None:
+                        self.discard_cached_window(chat_id, window_id)
+                    raise
+                if window.row.id != window_id:
+                    # Another window was shown instead, the pressed one stays in the session and is written with it.
+                    self.discard_cached_window(chat_id, window_id)
+                self.cache_window(window)
             await callback_query.answer()
         except PermissionError:
             await callback_query.answer('Извините, вы не можете активировать эту кнопку.', show_alert=True)
@@ -74,18 +126,33 @@ class TGBotGUIMixin:
         ).order_by(
             desc(tables.Window.id)
         )
+        if self.window_cache is not None:
+            # Windows waiting for input are looked up in the database, so the cached windows of the chat are written first.
+            await self.window_cache.invalidate_chat(message.chat.id)
         window = (await db.execute(stmt)).scalar()
         if not window:
             message.continue_propagation()
         window_class = window_registry[window.window_class_crc32]
-        try:
+        window_id = window.id
+        async with self.lock_window(message.chat.id, window_id):
+            if self.window_cache is not None and await self.window_cache.invalidate((message.chat.id, window_id)):
+                # The window was cached again by another update meanwhile.
+                await db.refresh(window)
             try:
-                window = await window_class.reconstruct(self, message.chat.id, window.id, row=window)
-            except ReconstructionError:
-                message.continue_propagation()
-            window.processing_input = True
-            await window.process_input(message)
-        except StopUserRequestProcessing as e:
-            window = e.window
-        await window.render()
+                try:
+                    try:
+                        window = await window_class.reconstruct(self, message.chat.id, window_id, row=window)
+                    except ReconstructionError:
+                        message.continue_propagation()
+                    window.processing_input = True
+                    await window.process_input(message)
+                except StopUserRequestProcessing as e:
+                    window = e.window
+                await window.render()
+            except BaseException:
+                self.discard_cached_window(message.chat.id, window_id)
+                raise
+            if window.row.id != window_id:
+                self.discard_cached_window(message.chat.id, window_id)
+            self.cache_window(window)
         message.stop_propagation()
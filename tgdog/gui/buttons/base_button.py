@@ -2,7 +2,6 @@ import uuid
 
 import pyrogram
 
-from tgdog.db import db
 from tgdog.gui.constants import CALLBACK_QUERY_SIGNATURE
 from tgdog.gui.registry import ButtonMeta
 
@@ -20,10 +19,14 @@ class BaseButton(metaclass=ButtonMeta):
         raise NotImplementedError
 
     def rebind(self):
-        db.add(self.row)
+        self.keyboard.tab.window.storage.add(self.row)
+
+    def expunge(self):
+        self.keyboard.tab.window.storage.expunge(self.row)
 
     async def db_render(self):
-        if self.row.id is None:
+        # Rows of blob windows never get an id, so the callback data tells whether the button is new.
+        if self.row.callback_data is None:
             self.row.callback_data = (
                 CALLBACK_QUERY_SIGNATURE  # 4 bytes
                 + self.keyboard.tab.window.crc32  # 4 bytes
@@ -31,15 +34,14 @@ class BaseButton(metaclass=ButtonMeta):
                 + self.crc32  # 4 bytes
                 + uuid.uuid4().bytes  # 16 bytes
             )
-            self.row.window = self.keyboard.tab.window.row
-        db.add(self.row)
+        self.keyboard.tab.window.storage.add(self.row)
 
     async def render(self):
         await self.db_render()
         return pyrogram.types.InlineKeyboardButton(self.text, callback_data=self.row.callback_data)
 
     async def destroy(self):
-        await db.delete(self.row)
+        await self.keyboard.tab.window.storage.delete(self.row)
 
     def get_column_value_or_default(self, name):
         value = getattr(self.row, name)
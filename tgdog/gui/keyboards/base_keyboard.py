@@ -1,7 +1,5 @@
 import pyrogram
-from sqlalchemy import select
 
-from tgdog.db import db
 from tgdog.gui import tables
 from tgdog.gui.buttons import BaseButton
 from tgdog.gui.callback_query import current_callback_query
@@ -54,7 +52,19 @@ class BaseKeyboard:
         return buttons
 
     def rebind(self):
-        [button.rebind() for row in self.buttons for button in row]
+        for button in self.buttons_iter():
+            # Plain pyrogram buttons have no rows.
+            if not isinstance(button, BaseButton):
+                continue
+            # Buttons that were not rendered yet do not know the keyboard.
+            button.keyboard = self
+            button.rebind()
+
+    def expunge(self):
+        for button in self.buttons_iter():
+            if isinstance(button, BaseButton):
+                button.keyboard = self
+                button.expunge()
 
     async def render(self):
         keyboard = []
@@ -91,11 +101,14 @@ class BaseKeyboard:
                 self.buttons[-1].append(button.text)
                 callback_data_position_map[button.callback_data] = (row_index, column_index)
         buttons_data = []
+        storage = self.tab.window.storage
+        loaded_rows = self.tab.window.loaded_rows
         for button_class, buttons_callback_data in button_classes_data_map.items():
-            stmt = select(button_class.table).where(
-                button_class.table.callback_data.in_(buttons_callback_data)
-            )
-            temp = (await db.execute(stmt)).scalars()
+            if button_class.table in loaded_rows:
+                # Several button classes can share a table.
+                temp = [r for r in loaded_rows[button_class.table] if r.callback_data in buttons_callback_data]
+            else:
+                temp = await storage.get_rows(button_class.table, callback_data=buttons_callback_data)
             buttons_data.extend([{'class': button_class, 'row': b} for b in temp])
         if len(buttons_data) != db_buttons_count:
             raise ReconstructionError(f'{len(buttons_data)} buttons out of {db_buttons_count} were fetched')
@@ -129,14 +142,11 @@ class BaseKeyboard:
                     db_row.right_button = True
                 db_row.tab_index = self.tab.window.row.current_tab_index
                 db_row.window_id = self.tab.window.row.id
-                db.add(db_row)
+                self.tab.window.storage.add(db_row)
 
     async def restore(self):
-        stmt = select(tables.PyrogramButton).where(
-            tables.PyrogramButton.window_id == self.tab.window.row.id,
-            tables.PyrogramButton.tab_index == self.tab.row.index_in_window
-        )
-        db_buttons = (await db.execute(stmt)).scalars()
+        storage = self.tab.window.storage
+        db_buttons = await storage.get_rows(tables.PyrogramButton, tab_index=self.tab.row.index_in_window)
         buttons = []
         new_row = []
         for db_button in db_buttons:
@@ -145,7 +155,7 @@ class BaseKeyboard:
             if db_button.right_button:
                 buttons.append(new_row)
                 new_row = []
-            await db.delete(db_button)
+            await storage.delete(db_button)
         await self.reconstruct(buttons)
 
     async def destroy(self):
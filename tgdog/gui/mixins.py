@@ -2,6 +2,7 @@ from sqlalchemy import (
     Boolean,
     Column,
     ForeignKey,
+    Index,
     Integer,
     JSON,
     LargeBinary,
@@ -30,6 +31,10 @@ class TableWithWindowMixin:
 
 
 class TabMixin(TableWithWindowMixin):
+    @declared_attr
+    def __table_args__(cls):
+        return (Index(f'ix_{cls.__tablename__}_window_id_index_in_window', 'window_id', 'index_in_window'),)
+
     id = Column(Integer, primary_key=True)
     index_in_window = Column(Integer)
     text = Column(String)
@@ -42,6 +47,10 @@ class TabMixin(TableWithWindowMixin):
 
 
 class TextMixin(TableWithWindowMixin):
+    @declared_attr
+    def __table_args__(cls):
+        return (Index(f'ix_{cls.__tablename__}_window_id_tab_index_tab_id', 'window_id', 'tab_index', 'tab_id'),)
+
     id = Column(Integer, primary_key=True)
     tab_index = Column(Integer)
     tab_id = Column(Integer)
@@ -51,6 +60,11 @@ class TextMixin(TableWithWindowMixin):
 
 
 class BaseButtonMixin(TableWithWindowMixin):
+    # Buttons are looked up by callback data, the window is needed to delete them along with the window.
+    @declared_attr
+    def __table_args__(cls):
+        return (Index(f'ix_{cls.__tablename__}_window_id', 'window_id'),)
+
     id = Column(Integer, primary_key=True)
     callback_data = Column(LargeBinary(64), unique=True, nullable=False)
     name = Column(String)
@@ -0,0 +1,347 @@
+import base64
+import datetime
+import decimal
+import json
+
+import sqlalchemy
+from sqlalchemy import and_, bindparam, inspect, select
+from sqlalchemy.orm import aliased
+
+from tgdog.db import db, tables
+from tgdog.gui.exceptions import ReconstructionError
+from tgdog.gui.registry import button_registry
+
+# 1 was a pickled state, such blobs are not loaded.
+STATE_VERSION = 2
+load_rows_statements = {}
+state_columns = {}
+state_codecs = {}
+state_tables = {}
+
+
+def get_button_tables_data(buttons):
+    button_tables_data = {}
+    for row in buttons:
+        for button in row:
+            if not button.callback_data:
+                continue
+            button_class = button_registry.get(button.callback_data[12:16], None)
+            if button_class is not None:
+                button_tables_data.setdefault(button_class.table, []).append(button.callback_data)
+    return button_tables_data
+
+
+def get_state_columns(table):
+    # The row ids are not needed in a blob and the window id is the id of the blob row itself.
+    if table not in state_columns:
+        state_columns[table] = tuple(
+            attr.key for attr in inspect(table).column_attrs
+            if attr.key not in ('id', 'window_id')
+        )
+    return state_columns[table]
+
+
+def encode_bytes(value):
+    return base64.b64encode(value).decode()
+
+
+def get_state_codec(column):
+    # Values that JSON has no type for are stored as strings, (encode, decode) or None if the value is stored as is.
+    column_type = column.type
+    if isinstance(column_type, sqlalchemy.LargeBinary):
+        return encode_bytes, base64.b64decode
+    if isinstance(column_type, sqlalchemy.DateTime):
+        return datetime.datetime.isoformat, datetime.datetime.fromisoformat
+    if isinstance(column_type, sqlalchemy.Date):
+        return datetime.date.isoformat, datetime.date.fromisoformat
+    if isinstance(column_type, sqlalchemy.Time):
+        return datetime.time.isoformat, datetime.time.fromisoformat
+    if isinstance(column_type, sqlalchemy.Numeric) and column_type.asdecimal:
+        return str, decimal.Decimal
+    return None
+
+
+def get_state_codecs(table):
+    if table not in state_codecs:
+        codecs = {}
+        for attr in inspect(table).column_attrs:
+            codec = get_state_codec(attr.columns[0])
+            if codec is not None:
+                codecs[attr.key] = codec
+        state_codecs[table] = codecs
+    return state_codecs[table]
+
+
+def get_state_table(name):
+    if not state_tables:
+        for mapper in tables.Base.registry.mappers:
+            state_tables[mapper.local_table.name] = mapper.class_
+    return state_tables[name]
+
+
+def get_window_relationships():
+    return inspect(tables.Window).relationships.keys()
+
+
+def get_state_value(value):
+    # Mutable JSON values are saved as plain ones.
+    if isinstance(value, dict):
+        return dict(value)
+    if isinstance(value, list):
+        return list(value)
+    return value
+
+
+def save_window_states(session):
+    # Rows of blob windows are changed in place, so the blobs are made right before the commit.
+    for storage in session.info.get('window_storages', ()):
+        storage.save_state()
+
+
+class RelationalStorage:
+    # Window, tabs, texts and buttons are stored in their own tables.
+
+    def __init__(self, window):
+        self.window = window
+
+    @classmethod
+    def get_load_rows_statement(cls, window_class, button_table):
+        # Building the statement costs more than executing it, so it is built once for a window class and a button table.
+        # The current tab is not known in advance, so every tab of the window is joined by the current tab index,
+        # only one of them matches.
+        key = (window_class, button_table)
+        if key in load_rows_statements:
+            return load_rows_statements[key]
+        window_table = tables.Window
+        stmt = select(window_table)
+        tab_positions = {}
+        for tab_class in window_class.tabs:
+            tables_key = (tab_class.table, tab_class.text_class.table)
+            if tables_key in tab_positions:
+                continue
+            tab_alias = aliased(tab_class.table)
+            text_alias = aliased(tab_class.text_class.table)
+            stmt = stmt.add_columns(tab_alias, text_alias).outerjoin(tab_alias, and_(
+                tab_alias.window_id == window_table.id,
+                tab_alias.index_in_window == window_table.current_tab_index,
+            )).outerjoin(text_alias, and_(
+                text_alias.window_id == window_table.id,
+                text_alias.tab_index == window_table.current_tab_index,
+                text_alias.tab_id == tab_alias.id,
+            ))
+            tab_positions[tables_key] = 1 + len(tab_positions) * 2
+        if button_table is not None:
+            stmt = stmt.add_columns(button_table).outerjoin(
+                button_table,
+                button_table.callback_data.in_(bindparam('callback_data', expanding=True)),
+            )
+        stmt = stmt.where(
+            window_table.id == bindparam('window_id'),
+            window_table.chat_id == bindparam('chat_id'),
+        )
+        load_rows_statements[key] = (stmt, tab_positions)
+        return stmt, tab_positions
+
+    @classmethod
+    async def load_window(cls, window_class, chat_id, window_id, buttons, row=None):
+        # The window, its current tab with the text and the buttons of one table are fetched with one query.
+        # Joining several button tables would multiply the rows, so only the largest group is joined,
+        # the keyboard selects the rest by itself.
+        button_tables_data = get_button_tables_data(buttons)
+        button_table = None
+        params = {'window_id': window_id, 'chat_id': chat_id}
+        if button_tables_data:
+            button_table = max(button_tables_data, key=lambda t: len(button_tables_data[t]))
+            params['callback_data'] = button_tables_data[button_table]
+        stmt, tab_positions = cls.get_load_rows_statement(window_class, button_table)
+        result_rows = (await db.execute(stmt, params)).all()
+        if not result_rows:
+            return None, {}
+        row = result_rows[0][0]
+        loaded_rows = {}
+        if row.current_tab_index is not None and row.current_tab_index < len(window_class.tabs):
+            tab_class = window_class.tabs[row.current_tab_index]
+            tables_key = (tab_class.table, tab_class.text_class.table)
+            position = tab_positions[tables_key]
+            loaded_rows[tables_key[0]] = result_rows[0][position]
+            loaded_rows[tables_key[1]] = result_rows[0][position+1]
+        if button_table is not None:
+            loaded_rows[button_table] = list({
+                id(r[-1]): r[-1] for r in result_rows if r[-1] is not None
+            }.values())
+        return row, loaded_rows
+
+    def add(self, row):
+        # New rows of a window that is not inserted yet are bound to it through the relationship,
+        # the id will be known after the flush.
+        if row is not self.window.row and row.window_id is None:
+            if self.window.row.id is None:
+                row.window = self.window.row
+            else:
+                row.window_id = self.window.row.id
+        db.add(row)
+
+    def expunge(self, row):
+        state = inspect(row)
+        if state.session_id is None:
+            return
+        if row is self.window.row and state.persistent:
+            # Otherwise the expunge would cascade to the rows that were removed from the window in this session.
+            db.expire(row, get_window_relationships())
+        db.expunge(row)
+
+    async def delete(self, row):
+        state = inspect(row)
+        if state.key is None:
+            # The row was not inserted yet, for example it belongs to a cached window that is not written yet.
+            if state.session_id is not None:
+                db.expunge(row)
+            return
+        await db.delete(row)
+
+    async def flush(self):
+        await db.flush()
+
+    def get_statement(self, table, values):
+        conditions = [table.window_id == self.window.row.id]
+        for key, value in values.items():
+            column = getattr(table, key)
+            conditions.append(column.in_(value) if isinstance(value, list) else column == value)
+        return select(table).where(*conditions)
+
+    async def get_row(self, table, **values):
+        return (await db.execute(self.get_statement(table, values))).scalar()
+
+    async def get_rows(self, table, **values):
+        return (await db.execute(self.get_statement(table, values))).scalars().all()
+
+
+class BlobStorage:
+    # Tabs, texts and buttons of the window are stored as one blob in the window row,
+    # the rows live only in memory and are serialized right before the commit.
+    # Only the window row is added to the session, so rendering does not insert or update a row per button.
+
+    def __init__(self, window):
+        self.window = window
+        self.rows = None
+
+    @classmethod
+    async def load_window(cls, window_class, chat_id, window_id, buttons, row=None):
+        if row is None:
+            stmt = select(tables.Window).where(
+                tables.Window.id == window_id,
+                tables.Window.chat_id == chat_id,
+            )
+            row = (await db.execute(stmt)).scalar()
+        return row, {}
+
+    def register(self):
+        db.info.setdefault('window_storages', set()).add(self)
+
+    def load_state(self):
+        self.rows = {}
+        if self.window.row.state is None:
+            return
+        if self.window.row.state_version != STATE_VERSION:
+            raise ReconstructionError(f'Unsupported window state version {self.window.row.state_version}')
+        for table_name, keys, values_list in json.loads(self.window.row.state):
+            table = get_state_table(table_name)
+            codecs = get_state_codecs(table)
+            decoders = [codecs[key][1] if key in codecs else None for key in keys]
+            for values in values_list:
+                row = table(**{
+                    key: decode(value) if decode is not None and value is not None else value
+                    for key, decode, value in zip(keys, decoders, values)
+                })
+                self.rows[id(row)] = row
+
+    def get_loaded_rows(self):
+        if self.rows is None:
+            self.load_state()
+            self.register()
+        return self.rows
+
+    def dump_state(self):
+        state = {}
+        for row in self.rows.values():
+            table = type(row)
+            keys = get_state_columns(table)
+            codecs = get_state_codecs(table)
+            if table.__tablename__ not in state:
+                state[table.__tablename__] = (table.__tablename__, keys, [])
+            values = []
+            for key in keys:
+                value = get_state_value(getattr(row, key))
+                if key in codecs and value is not None:
+                    value = codecs[key][0](value)
+                values.append(value)
+            state[table.__tablename__][2].append(values)
+        return json.dumps(list(state.values()), ensure_ascii=False, separators=(',', ':')).encode()
+
+    def save_state(self):
+        if self.rows is None:
+            return
+        state = self.dump_state()
+        if state != self.window.row.state:
+            self.window.row.state = state
+            self.window.row.state_version = STATE_VERSION
+
+    def apply_defaults(self, row):
+        # The rows are never inserted, so the defaults of the columns are set here.
+        for column in row.__table__.columns:
+            if column.default is None or column.key not in get_state_columns(type(row)):
+                continue
+            if getattr(row, column.key) is not None:
+                continue
+            if column.default.is_scalar:
+                setattr(row, column.key, column.default.arg)
+            elif column.default.is_callable:
+                setattr(row, column.key, column.default.arg(None))
+
+    def add(self, row):
+        if row is self.window.row:
+            db.add(row)
+            self.register()
+            return
+        rows = self.get_loaded_rows()
+        if id(row) not in rows:
+            self.apply_defaults(row)
+            rows[id(row)] = row
+        self.register()
+
+    def expunge(self, row):
+        if row is not self.window.row:
+            return
+        db.info.get('window_storages', set()).discard(self)
+        if inspect(row).session_id is not None:
+            db.expunge(row)
+
+    async def delete(self, row):
+        if row is self.window.row:
+            db.info.get('window_storages', set()).discard(self)
+            self.rows = None
+            await db.delete(row)
+            return
+        self.get_loaded_rows().pop(id(row), None)
+
+    async def flush(self):
+        # Only the id of the window is needed.
+        if self.window.row.id is None:
+            await db.flush()
+
+    async def get_rows(self, table, **values):
+        rows = []
+        for row in self.get_loaded_rows().values():
+            if type(row) is not table:
+                continue
+            for key, value in values.items():
+                row_value = getattr(row, key)
+                if (row_value not in value) if isinstance(value, list) else (row_value != value):
+                    break
+            else:
+                rows.append(row)
+        return rows
+
+    async def get_row(self, table, **values):
+        rows = await self.get_rows(table, **values)
+        return rows[0] if rows else None
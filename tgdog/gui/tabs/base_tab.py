@@ -1,6 +1,3 @@
-from sqlalchemy import select
-
-from tgdog.db import db
 from tgdog.gui.exceptions import (
     GUIError,
     ReconstructionError,
@@ -33,19 +30,24 @@ class BaseTab:
         return self.keyboard_class(self)
 
     async def build(self, *args, **kwargs):
-        self.row = self.table(*args, window=self.window.row, **kwargs)
+        self.row = self.table(*args, **kwargs)
         self.row.index_in_window = self.window.row.current_tab_index
-        db.add(self.row)
+        self.window.storage.add(self.row)
         # In some places further window and tab identifiers will be needed.
         # Therefore, we need to insert the previously created window and tab to the database.
-        await db.flush()
+        await self.window.storage.flush()
         await self.text.build()
 
     def rebind(self):
-        db.add(self.row)
+        self.window.storage.add(self.row)
         self.text.rebind()
         self.keyboard.rebind()
 
+    def expunge(self):
+        self.window.storage.expunge(self.row)
+        self.text.expunge()
+        self.keyboard.expunge()
+
     async def render(self):
         if self.rerender_text or not self.message_text:
             if self.row.input_processing_enabled and self.input_fields[self.row.current_input_field_name].text:
@@ -57,11 +59,13 @@ class BaseTab:
         return text, keyboard
 
     async def reconstruct(self, text, buttons):
-        stmt = select(self.table).where(
-            self.table.window_id == self.window.row.id,
-            self.table.index_in_window == self.window.row.current_tab_index
-        )
-        self.row = (await db.execute(stmt)).scalar()
+        if self.table in self.window.loaded_rows:
+            self.row = self.window.loaded_rows[self.table]
+        else:
+            self.row = await self.window.storage.get_row(
+                self.table,
+                index_in_window=self.window.row.current_tab_index,
+            )
         if not self.row:
             raise ReconstructionError('Tab not found')
         self.message_text = text
@@ -116,11 +120,10 @@ class BaseTab:
         await self.keyboard.save()
 
     async def restore(self):
-        stmt = select(self.table).where(
-            self.table.window_id == self.window.row.id,
-            self.table.index_in_window == self.window.row.current_tab_index
+        row = await self.window.storage.get_row(
+            self.table,
+            index_in_window=self.window.row.current_tab_index,
         )
-        row = (await db.execute(stmt)).scalar()
         if not row:
             raise GUIError('Tab restore failed')
         self.row = row
@@ -131,6 +134,6 @@ class BaseTab:
             raise GUIError('Tab restore succeeded, but reconstruction failed')
 
     async def destroy(self):
-        await db.delete(self.row)
+        await self.window.storage.delete(self.row)
         await self.text.destroy()
         await self.keyboard.destroy()
@@ -1,6 +1,3 @@
-from sqlalchemy import select
-
-from tgdog.db import db
 from tgdog.gui.exceptions import ReconstructionError
 
 
@@ -18,10 +15,13 @@ class BaseText:
             tab_id=self.tab.row.id,
             **kwargs
         )
-        db.add(self.row)
+        self.tab.window.storage.add(self.row)
 
     def rebind(self):
-        db.add(self.row)
+        self.tab.window.storage.add(self.row)
+
+    def expunge(self):
+        self.tab.window.storage.expunge(self.row)
 
     def set_header(self, header, one_time=True):
         self.row.header = header
@@ -60,12 +60,14 @@ class BaseText:
 
     async def reconstruct(self, text):
         # The initial text does not seem to be needed here, but let it be just in case
-        stmt = select(self.table).where(
-            self.table.window_id == self.tab.window.row.id,
-            self.table.tab_index == self.tab.row.index_in_window,
-            self.table.tab_id == self.tab.row.id,
-        )
-        self.row = (await db.execute(stmt)).scalar()
+        if self.table in self.tab.window.loaded_rows:
+            self.row = self.tab.window.loaded_rows[self.table]
+        else:
+            self.row = await self.tab.window.storage.get_row(
+                self.table,
+                tab_index=self.tab.row.index_in_window,
+                tab_id=self.tab.row.id,
+            )
         if not self.row:
             raise ReconstructionError('Text not found')
 
@@ -76,4 +78,4 @@ class BaseText:
         await self.reconstruct(None)
 
     async def destroy(self):
-        await db.delete(self.row)
+        await self.tab.window.storage.delete(self.row)
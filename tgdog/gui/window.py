@@ -10,6 +10,7 @@ from tgdog.gui.exceptions import (
     PermissionError,
 )
 from tgdog.gui.registry import WindowMeta
+from tgdog.gui.storage import RelationalStorage
 from tgdog.gui import tables
 from tgdog.users import current_user
 
@@ -19,12 +20,17 @@ class Window(metaclass=WindowMeta):
     edit_message_kwargs = None
     message_kwargs = None
     resend_window_message_after_input_processing = True
+    storage_class = RelationalStorage
 
     def __init__(self, controller, chat_id, user_id=None):
         self.controller = controller
         self.chat_id = chat_id
         self.user_id = user_id
         self.processing_input = False
+        self.destroyed = False
+        self.storage = self.storage_class(self)
+        # Rows fetched in advance by reconstruct, by table, tabs, texts and keyboards take them from here.
+        self.loaded_rows = {}
 
     def find_tab_index_by_class(self, tab_class):
         try:
@@ -44,13 +50,17 @@ class Window(metaclass=WindowMeta):
         tab_index = 0 if not tab else self.find_tab_index_by_class(tab)
         self.current_tab = self.tabs[tab_index](self)
         self.row.current_tab_index = tab_index
-        db.add(self.row)
+        self.storage.add(self.row)
         await self.current_tab.build(*args, **kwargs)
 
     def rebind(self):
-        db.add(self.row)
+        self.storage.add(self.row)
         self.current_tab.rebind()
 
+    def expunge(self):
+        self.storage.expunge(self.row)
+        self.current_tab.expunge()
+
     async def render(
         self,
         send_message_kwargs=None,
@@ -72,6 +82,7 @@ class Window(metaclass=WindowMeta):
             resend_window_message = self.processing_input and self.resend_window_message_after_input_processing
             delete_previous_window_message_before_resending = True
         if resend_window_message and self.row.message_id:
+            self.controller.discard_message_edit(self.row.chat_id, self.row.message_id)
             if delete_previous_window_message_before_resending:
                 try:
                     await self.controller.app.delete_messages(self.row.chat_id, self.row.message_id)
@@ -91,27 +102,17 @@ class Window(metaclass=WindowMeta):
                 return
             self.row.message_id = message.id
         else:
-            try:
-                await self.controller.app.edit_message_text(
-                    self.row.chat_id,
-                    self.row.message_id,
-                    text,
-                    reply_markup=keyboard,
-                    **message_kwargs | edit_message_kwargs,
-                )
-            except pyrogram.errors.MessageNotModified:
-                pass
+            # Not awaited, quick successive renders of the same window are collapsed into the last one.
+            self.controller.edit_message_text_sync(
+                self.row.chat_id,
+                self.row.message_id,
+                text,
+                reply_markup=keyboard,
+                **message_kwargs | edit_message_kwargs,
+            )
 
     @classmethod
-    async def reconstruct(cls, controller, chat_id, window_id, message=None, row=None):
-        if not row:
-            stmt = select(tables.Window).where(
-                tables.Window.id==window_id,
-                tables.Window.chat_id==chat_id,
-            )
-            row = (await db.execute(stmt)).scalar()
-        if row is None:
-            raise NoWindowError
+    async def check_permission(cls, controller, chat_id, row):
         # If we process a callback query, we will always have the current user.
         current_user_id = current_user.user_id if current_user.is_set else ANONYMOUS_USER_ID
         if row.user_id == ANONYMOUS_USER_ID and current_callback_query.is_set:
@@ -126,6 +127,24 @@ class Window(metaclass=WindowMeta):
                 current_user_id = ANONYMOUS_USER_ID
         if row.user_id != DEFAULT_USER_ID and row.user_id != current_user_id:
             raise PermissionError
+
+    @classmethod
+    async def reconstruct(cls, controller, chat_id, window_id, message=None, row=None):
+        loaded_rows = None
+        if not row and message is not None:
+            buttons = []
+            if isinstance(message.reply_markup, pyrogram.types.InlineKeyboardMarkup):
+                buttons = message.reply_markup.inline_keyboard
+            row, loaded_rows = await cls.storage_class.load_window(cls, chat_id, window_id, buttons)
+        elif not row:
+            stmt = select(tables.Window).where(
+                tables.Window.id==window_id,
+                tables.Window.chat_id==chat_id,
+            )
+            row = (await db.execute(stmt)).scalar()
+        if row is None:
+            raise NoWindowError
+        await cls.check_permission(controller, chat_id, row)
         if message is None:
             message = await controller.app.get_messages(chat_id, row.message_id)
             # "A message can be empty in case it was deleted or you tried to retrieve a message that doesn’t exist yet."
@@ -137,10 +156,19 @@ class Window(metaclass=WindowMeta):
         buttons = []
         if isinstance(message.reply_markup, pyrogram.types.InlineKeyboardMarkup):
             buttons = message.reply_markup.inline_keyboard
+        if loaded_rows is None:
+            # The message was not known before, now the rows can be fetched together.
+            row, loaded_rows = await cls.storage_class.load_window(cls, chat_id, window_id, buttons, row=row)
+            if row is None:
+                raise NoWindowError
         window = cls(controller, row.chat_id, row.user_id)
         window.row = row
+        window.loaded_rows = loaded_rows
         window.current_tab = window.tabs[row.current_tab_index](window)
-        await window.current_tab.reconstruct(message.text, buttons)
+        try:
+            await window.current_tab.reconstruct(message.text, buttons)
+        finally:
+            window.loaded_rows = {}
         return window
 
     async def destroy(self):
@@ -151,7 +179,8 @@ class Window(metaclass=WindowMeta):
             await self.current_tab.restore()
             await self.current_tab.destroy()
 
-        await db.delete(self.row)
+        await self.storage.delete(self.row)
+        self.destroyed = True
 
     async def handle_button_activation(self):
         await self.current_tab.handle_button_activation()
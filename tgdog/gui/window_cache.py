@@ -0,0 +1,197 @@
+import asyncio
+from collections import OrderedDict
+import contextlib
+
+import pyrogram
+from sqlalchemy import inspect
+
+from tgdog.db import DBManager, db
+
+FLUSH_BATCH_SIZE = 100
+
+
+def get_window_callback_data(window):
+    callback_data = set()
+    for button in window.current_tab.keyboard.buttons_iter():
+        if isinstance(button, pyrogram.types.InlineKeyboardButton):
+            data = button.callback_data
+        else:
+            data = button.row.callback_data
+        if data:
+            callback_data.add(data)
+    return callback_data
+
+
+def get_message_callback_data(message):
+    callback_data = set()
+    if isinstance(message.reply_markup, pyrogram.types.InlineKeyboardMarkup):
+        for row in message.reply_markup.inline_keyboard:
+            for button in row:
+                if button.callback_data:
+                    callback_data.add(button.callback_data)
+    return callback_data
+
+
+class WindowCache:
+    # Live windows by (chat_id, window_id), the least recently used ones are evicted first.
+    # A window taken from the cache is bound to the session of the update,
+    # after rendering its rows are expunged from it, and the changes are written later by the worker in batches.
+    # Windows that have changes not yet written stay in dirty_windows even after eviction,
+    # so the database is never read instead of them.
+
+    def __init__(self, controller, max_size, flush_interval):
+        self.controller = controller
+        self.max_size = max_size
+        self.flush_interval = flush_interval
+        self.windows = OrderedDict()
+        self.dirty_windows = {}
+        # Only one update or flush at a time works with a window.
+        self.locks = {}
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.flushed = 0
+
+    @contextlib.asynccontextmanager
+    async def lock(self, chat_id, window_id):
+        key = (chat_id, window_id)
+        if key not in self.locks:
+            self.locks[key] = [asyncio.Lock(), 0]
+        lock_info = self.locks[key]
+        lock_info[1] += 1
+        try:
+            async with lock_info[0]:
+                yield
+        finally:
+            lock_info[1] -= 1
+            if not lock_info[1]:
+                del self.locks[key]
+
+    def is_locked(self, key):
+        return key in self.locks
+
+    async def get(self, window_class, chat_id, window_id, message):
+        # Must be called under the lock of the window.
+        key = (chat_id, window_id)
+        window = self.windows.get(key) or self.dirty_windows.get(key)
+        if window is None:
+            self.misses += 1
+            return None
+        if (
+            type(window) is not window_class
+            or message.id != window.row.message_id
+            # The message was edited elsewhere, or the last edit did not reach it yet.
+            or get_message_callback_data(message) != get_window_callback_data(window)
+        ):
+            await self.invalidate(key)
+            self.misses += 1
+            return None
+        existing_row = self.get_existing_row(window)
+        if existing_row is not None:
+            await self.invalidate(key)
+            # The row will be refreshed by the reconstruction.
+            db.expire(existing_row)
+            self.misses += 1
+            return None
+        await window.check_permission(self.controller, chat_id, window.row)
+        self.windows[key] = window
+        self.windows.move_to_end(key)
+        self.hits += 1
+        window.processing_input = False
+        window.current_tab.message_text = message.text
+        window.rebind()
+        return window
+
+    def get_existing_row(self, window):
+        # The row could be loaded by the session of the update bypassing the cache.
+        identity_key = inspect(window.row).identity_key
+        if identity_key is None:
+            return None
+        existing_row = db.identity_map.get(identity_key)
+        return existing_row if existing_row is not window.row else None
+
+    def put(self, window):
+        # Must be called under the lock of the window, after rendering.
+        key = (window.row.chat_id, window.row.id)
+        if window.destroyed or not window.row.message_id:
+            self.discard(key)
+            return
+        window.expunge()
+        self.windows[key] = window
+        self.windows.move_to_end(key)
+        self.dirty_windows[key] = window
+        while len(self.windows) > self.max_size:
+            self.windows.popitem(last=False)
+
+    def discard(self, key):
+        # Unwritten changes are dropped as well, the window is either deleted or its session was rolled back.
+        if self.windows.pop(key, None) is not None:
+            self.invalidations += 1
+        self.dirty_windows.pop(key, None)
+
+    async def invalidate(self, key):
+        # Must be called under the lock of the window.
+        window = self.dirty_windows.get(key)
+        if window is not None:
+            await self.write([window])
+        cached = key in self.windows
+        self.discard(key)
+        return window is not None or cached
+
+    async def invalidate_chat(self, chat_id):
+        keys = {key for key in [*self.windows, *self.dirty_windows] if key[0] == chat_id}
+        for key in keys:
+            async with self.lock(*key):
+                await self.invalidate(key)
+
+    async def worker(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def flush(self, wait=False):
+        keys = [key for key in self.dirty_windows if wait or not self.is_locked(key)]
+        for i in range(0, len(keys), FLUSH_BATCH_SIZE):
+            async with contextlib.AsyncExitStack() as stack:
+                windows = []
+                for key in keys[i:i+FLUSH_BATCH_SIZE]:
+                    await stack.enter_async_context(self.lock(*key))
+                    # The window could be written or discarded while waiting for the lock.
+                    if key in self.dirty_windows:
+                        windows.append(self.dirty_windows[key])
+                if not windows:
+                    continue
+                await self.write(windows)
+
+    async def write(self, windows):
+        keys = [(window.row.chat_id, window.row.id) for window in windows]
+        try:
+            async with DBManager(self.controller):
+                for window in windows:
+                    window.rebind()
+        except Exception:
+            # The rollback expires the rows, so the windows cannot be used anymore and their changes are lost.
+            self.controller.log.exception(f'Не удалось сохранить окна ({len(windows)}), они удалены из кэша:')
+            for key in keys:
+                self.discard(key)
+            return
+        for key in keys:
+            self.dirty_windows.pop(key, None)
+        self.flushed += len(windows)
+        self.controller.log.debug(f'Сохранено окон: {len(windows)}')
+
+    async def close(self):
+        await self.flush(wait=True)
+
+    @property
+    def stats(self):
+        requests = self.hits + self.misses
+        return {
+            'size': len(self.windows),
+            'dirty': len(self.dirty_windows),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / requests if requests else 0,
+            'invalidations': self.invalidations,
+            'flushed': self.flushed,
+        }
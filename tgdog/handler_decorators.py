@@ -1,19 +1,41 @@
-import copy
 import inspect
+import itertools
 import re
 import sys
 
 import pyrogram
 
-handlers = []
+HANDLERS_ATTRIBUTE = 'tgdog_handlers'
 SNAKE_TO_CAMEL_CASE_REGEX = re.compile(r'^.|_.')
+# Handlers are kept on the decorated functions, so every controller class sees only the handlers of its own mro,
+# and the counter keeps them in the order of declaration.
+handler_counter = itertools.count()
+# All the declared handlers, for get_handlers without a class.
+handlers = []
+# Handlers declared before the last clear_handlers call are not registered.
+first_handler_index = 0
 
-def get_handlers():
-    return copy.deepcopy(handlers)
+def get_handlers(cls=None):
+    # Without a class all the declared handlers are returned, as before the handlers were bound to classes.
+    if cls is None:
+        found_handlers = {h['index']: h for h in handlers}
+    else:
+        found_handlers = {}
+        for klass in reversed(cls.__mro__):
+            for attr in vars(klass).values():
+                if inspect.isfunction(attr):
+                    found_handlers.update((h['index'], h) for h in getattr(attr, HANDLERS_ATTRIBUTE, ()))
+    found_handlers = [h for h in found_handlers.values() if h['index'] >= first_handler_index]
+    found_handlers.sort(key=lambda h: h['index'])
+    # The handlers are read only by the controller, which only pops from handler_kwargs.
+    return [h | {'handler_kwargs': dict(h['handler_kwargs'])} for h in found_handlers]
 
 
 def clear_handlers():
+    # Kept for compatibility, the handlers declared so far are not registered by controllers started afterwards.
+    global first_handler_index
     handlers.clear()
+    first_handler_index = next(handler_counter)
 
 
 def make_handler_decorator(handler):
@@ -26,7 +48,11 @@ def make_handler_decorator(handler):
                 'handler_args': handler_args,
                 'handler_kwargs': handler_kwargs,
                 'handler_name': func.__name__,
+                'index': next(handler_counter),
             }
+            if HANDLERS_ATTRIBUTE not in vars(func):
+                setattr(func, HANDLERS_ATTRIBUTE, [])
+            getattr(func, HANDLERS_ATTRIBUTE).append(handler_info)
             handlers.append(handler_info)
             return func
         return decorator
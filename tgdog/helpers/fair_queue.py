@@ -0,0 +1,59 @@
+from collections import deque
+
+
+class FairQueue:
+    # Round-robin over keys, items of the same key are returned in FIFO order.
+    # A returned key is busy until released, so at most one item per key is in progress.
+
+    def __init__(self):
+        self.queues = {}
+        self.ready_keys = deque()
+        self.busy_keys = set()
+        self.length = 0
+
+    def __len__(self):
+        return self.length
+
+    @property
+    def ready(self):
+        return bool(self.ready_keys)
+
+    def append(self, key, item):
+        queue = self.queues.get(key)
+        if queue is None:
+            queue = self.queues[key] = deque()
+            if key not in self.busy_keys:
+                self.ready_keys.append(key)
+        queue.append(item)
+        self.length += 1
+
+    def popleft(self):
+        key = self.ready_keys.popleft()
+        queue = self.queues[key]
+        item = queue.popleft()
+        if not queue:
+            del self.queues[key]
+        self.busy_keys.add(key)
+        self.length -= 1
+        return item
+
+    def remove(self, key, item):
+        # Returns False if the item is not queued, for example because it is already returned.
+        queue = self.queues.get(key)
+        if queue is None:
+            return False
+        try:
+            queue.remove(item)
+        except ValueError:
+            return False
+        if not queue:
+            del self.queues[key]
+            if key not in self.busy_keys:
+                self.ready_keys.remove(key)
+        self.length -= 1
+        return True
+
+    def release(self, key):
+        self.busy_keys.discard(key)
+        if key in self.queues:
+            self.ready_keys.append(key)
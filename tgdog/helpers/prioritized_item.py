@@ -1,8 +0,0 @@
-from dataclasses import dataclass, field
-from typing import Any
-
-@dataclass(order=True)
-class PrioritizedItem:
-    priority: int
-    id: int
-    item: Any=field(compare=False)
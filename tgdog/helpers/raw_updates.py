@@ -0,0 +1,40 @@
+from pyrogram.raw.types import (
+    PeerUser,
+    UpdateBotCallbackQuery,
+    UpdateEditChannelMessage,
+    UpdateEditMessage,
+    UpdateNewChannelMessage,
+    UpdateNewMessage,
+)
+from pyrogram.utils import get_peer_id
+
+MESSAGE_UPDATES = (
+    UpdateNewMessage,
+    UpdateNewChannelMessage,
+    UpdateEditMessage,
+    UpdateEditChannelMessage,
+)
+
+
+def get_update_peer(update):
+    if isinstance(update, MESSAGE_UPDATES):
+        # MessageEmpty may have no peer.
+        return getattr(update.message, 'peer_id', None)
+    if isinstance(update, UpdateBotCallbackQuery):
+        return update.peer
+
+
+def get_update_peer_id(update):
+    peer = get_update_peer(update)
+    if peer is not None:
+        return get_peer_id(peer)
+
+
+def get_update_user_id(update):
+    if isinstance(update, MESSAGE_UPDATES):
+        peer = getattr(update.message, 'from_id', None) or getattr(update.message, 'peer_id', None)
+        if isinstance(peer, PeerUser):
+            return peer.user_id
+        return None
+    # Callback queries, inline queries and most of the other user initiated updates.
+    return getattr(update, 'user_id', None)
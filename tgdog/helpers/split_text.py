@@ -1,11 +1,56 @@
 SPLIT_ERROR = 'Text cannot be split with the given parameters'
 
 
+def count_parts(units, unit_separator, fixed_part_length, max_part_length):
+    # The length of the part numbers depends on the total number of parts,
+    # so the parts are counted again until the total stops growing.
+    # Each pass is linear, and the number of passes is bounded by the number of digits in the total.
+    total_parts = 0
+    current_part = 1
+    position = 0
+    recalculation_required = False
+    while True:
+        part_header_length = fixed_part_length+len(str(current_part))
+        if current_part <= total_parts:
+            part_header_length += len(str(total_parts))
+        else:
+            part_header_length += len(str(total_parts+1))
+        if part_header_length >= max_part_length and position < len(units):
+            raise ValueError(SPLIT_ERROR)
+        free_chars = max_part_length - part_header_length
+        if unit_separator is None:
+            part_length = min(free_chars, len(units) - position)
+            position += part_length
+        else:
+            part_length = 0
+            while position < len(units):
+                unit_length = len(units[position])
+                if unit_length > free_chars:
+                    raise ValueError(SPLIT_ERROR)
+                if part_length:
+                    unit_length += len(unit_separator)
+                if part_length + unit_length > free_chars:
+                    break
+                part_length += unit_length
+                position += 1
+        if not part_length:
+            if not recalculation_required:
+                return total_parts
+            current_part = 1
+            position = 0
+            recalculation_required = False
+            continue
+        if current_part > total_parts:
+            total_parts += 1
+            recalculation_required = True
+        current_part += 1
+
+
 def split_text(header, body, max_part_length, unit='char', header_separator='\n', include_part_numbers=True):
     if len(header) + len(header_separator) + len(body)<=max_part_length:
         return [(header+header_separator if header else '')+body]
     if unit == 'char':
-        units = list(body)
+        units = body
         unit_separator = None
     if unit == 'word':
         units = body.split(' ')
@@ -19,47 +64,10 @@ def split_text(header, body, max_part_length, unit='char', header_separator='\n'
         fixed_part_length += 4 + len(header_separator)
     else:
         fixed_part_length += 1 + len(header_separator)
-    current_part = 1
-    temp_units = list(units)
-    recalculation_required = False
     if include_part_numbers:
-        while True:
-            part_header_length = fixed_part_length+len(str(current_part))
-            if current_part <= total_parts:
-                part_header_length += len(str(total_parts))
-            else:
-                part_header_length += len(str(total_parts+1))
-            if part_header_length >= max_part_length and temp_units:
-                raise ValueError(SPLIT_ERROR)
-            free_chars = max_part_length - part_header_length
-            if unit == 'char':
-                part_length = len(temp_units[:free_chars])
-                del temp_units[:free_chars]
-            else:
-                part_length = 0
-                for u in list(temp_units):
-                    if len(u)>free_chars:
-                        raise ValueError(SPLIT_ERROR)
-                    temp = 0
-                    if part_length:
-                        temp = len(unit_separator)
-                    temp += len(u)
-                    if part_length + temp > free_chars:
-                        break
-                    part_length += temp
-                    temp_units.remove(u)
-            if not part_length:
-                if not recalculation_required:
-                    break
-                current_part = 1
-                temp_units = list(units)
-                recalculation_required = False
-                continue
-            if current_part > total_parts:
-                total_parts += 1
-                recalculation_required = True
-            current_part += 1
+        total_parts = count_parts(units, unit_separator, fixed_part_length, max_part_length)
     messages = []
+    position = 0
     while True:
         if include_part_numbers:
             if header:
@@ -72,25 +80,32 @@ def split_text(header, body, max_part_length, unit='char', header_separator='\n'
             else:
                 message = ''
         if unit == 'char':
-            message_length = len(message)
-            message += ''.join(units[:max_part_length-message_length])
-            del units[:max_part_length-message_length]
+            part = units[position:position+max(max_part_length-len(message), 0)]
+            if not part:
+                raise ValueError(SPLIT_ERROR)
+            message += part
+            position += len(part)
         else:
+            message_parts = [message]
+            message_length = len(message)
             added = False
-            for u in list(units):
-                temp = ''
+            while position < len(units):
+                unit_length = len(units[position])
                 if added:
-                    temp = unit_separator
-                temp += u
-                if len(message) + len(temp) > max_part_length:
+                    unit_length += len(unit_separator)
+                if message_length + unit_length > max_part_length:
                     break
-                message += temp
+                if added:
+                    message_parts.append(unit_separator)
+                message_parts.append(units[position])
+                message_length += unit_length
                 added = True
-                units.remove(u)
-        if not added:
-            raise ValueError(SPLIT_ERROR)
+                position += 1
+            if not added:
+                raise ValueError(SPLIT_ERROR)
+            message = ''.join(message_parts)
         messages.append(message)
-        if not units:
+        if position >= len(units):
             break
     return messages
 
@@ -0,0 +1,73 @@
+import asyncio
+import logging
+import signal
+
+from tgdog.core import create_log_handlers
+from tgdog.db import create_db_engine
+
+
+class BotHost:
+    # Runs several bots in one process and one event loop.
+    # Bots keep their own clients, handlers and limiters,
+    # while the database engines (one per url) and the log handlers are shared.
+
+    def __init__(self, name='host'):
+        self.name = name
+        self.bots = []
+        self.db_engines = {}
+        self.log_handlers = create_log_handlers(show_logger_name=True)
+        self.log = logging.getLogger(self.name)
+        self.log.setLevel(logging.DEBUG)
+        for handler in self.log_handlers:
+            self.log.addHandler(handler)
+        self.canceling = False
+
+    def add_bot(self, bot):
+        if bot.processes > 1:
+            raise ValueError('Bots of a host cannot use several processes')
+        for other_bot in self.bots:
+            if other_bot.bot_name == bot.bot_name:
+                raise ValueError(f'Bot {bot.bot_name} is already added')
+            if other_bot.session_name == bot.session_name:
+                raise ValueError(f'Session {bot.session_name} is already used by bot {other_bot.bot_name}')
+        self.bots.append(bot)
+
+    def get_db_engine(self, db_url):
+        if db_url not in self.db_engines:
+            self.db_engines[db_url] = [create_db_engine(db_url), 0]
+            self.log.debug(f'Создан движок базы данных, всего движков: {len(self.db_engines)}')
+        self.db_engines[db_url][1] += 1
+        return self.db_engines[db_url][0]
+
+    async def release_db_engine(self, db_url):
+        engine_info = self.db_engines[db_url]
+        engine_info[1] -= 1
+        if engine_info[1]:
+            return
+        del self.db_engines[db_url]
+        await engine_info[0].dispose()
+
+    async def start(self):
+        spooling_db_urls = set()
+        for bot in self.bots:
+            if not bot.message_spool:
+                continue
+            # Spooled messages are not marked with the bot, so each spool needs its own database.
+            if bot.db_url in spooling_db_urls:
+                raise ValueError('Bots with message spool cannot share a database')
+            spooling_db_urls.add(bot.db_url)
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGINT, self.stop)
+        except NotImplementedError:
+            signal.signal(signal.SIGINT, lambda *args: self.stop())
+        self.log.info(f'Запуск ботов: {len(self.bots)}')
+        results = await asyncio.gather(*[bot.start() for bot in self.bots], return_exceptions=True)
+        for bot, result in zip(self.bots, results):
+            if isinstance(result, Exception):
+                self.log.error(f'Бот {bot.bot_name} завершился с ошибкой:', exc_info=result)
+        self.log.info('Все боты остановлены')
+
+    def stop(self):
+        self.canceling = True
+        for bot in self.bots:
+            bot.stop()
@@ -1,26 +1,126 @@
 import asyncio
+from collections import deque
 import time
 
+# Releasing waiters more often than this only adds event loop wakeups.
+MIN_RELEASE_INTERVAL = 0.005
+# After a pause caused by FloodWait the number of events per period starts from this fraction of the nominal one
+# and grows back linearly.
+FLOOD_WAIT_START_RATE = 0.25
+
 
 class Limiter:
-    def __init__(self, controller, amount, period, static=True, name=None):
+    def __init__(self, controller, amount, period, static=True, name=None, flood_wait_threshold=1):
         self.controller = controller
         self.amount = amount
         self.period = period
         self.static = static
         self.name = name
-        self.events = [0]*self.amount
+        # How many FloodWait errors within one period pause this limiter.
+        self.flood_wait_threshold = flood_wait_threshold
+        # Times of the last amount events, an event is allowed once the oldest of them is at least period old,
+        # so no window of period seconds ever has more than amount events, as with the list of the previous version.
+        self.events = deque(maxlen=self.amount)
+        self.last_event = time.monotonic()
+        self.flood_wait_times = deque()
+        self.paused_until = 0
+        self.ramp_duration = 0
+        self.flood_waits = 0
+        self.pauses = 0
+        # Waiters are released strictly in FIFO order by a single timer,
+        # so under a burst only the callers that actually got a slot wake up.
+        self.waiters = deque()
+        self.timer = None
         self.full_name = 'лимитер' if not self.name else 'лимитер '+self.name
         self.controller.log.debug(f'Создан {self.full_name} ({self.amount} событий за {self.period} секунд)')
 
+    def resize(self, amount):
+        self.amount = amount
+        self.events = deque(self.events, maxlen=amount)
+
+    def get_capacity(self, now):
+        # After a pause caused by FloodWait fewer events are allowed per period, the number grows back linearly.
+        if not self.ramp_duration:
+            return self.amount
+        elapsed = now - self.paused_until
+        if elapsed >= self.ramp_duration:
+            self.ramp_duration = 0
+            return self.amount
+        factor = FLOOD_WAIT_START_RATE + (1 - FLOOD_WAIT_START_RATE) * max(elapsed, 0) / self.ramp_duration
+        return max(1, int(self.amount * factor))
+
+    def get_next_event_time(self, now):
+        capacity = self.get_capacity(now)
+        next_event_time = now
+        if len(self.events) >= capacity:
+            next_event_time = self.events[-capacity] + self.period
+        return max(next_event_time, self.paused_until)
+
+    def add_event(self, now):
+        self.events.append(now)
+        self.last_event = now
+
     async def __call__(self):
-        delay = max(self.period-(time.time()-self.events[0]), 0)
+        now = time.monotonic()
+        if not self.waiters and self.get_next_event_time(now) <= now:
+            self.add_event(now)
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        delay = self.get_next_event_time(now) - now + (len(self.waiters) - 1) * self.period / self.amount
         self.controller.log.debug(f'{self.full_name}: задержка {round(delay, 3)}')
-        self.events.append(time.time()+delay)
-        del self.events[0]
-        if delay > 0:
-            await asyncio.sleep(delay)
+        self.schedule_release(now)
+        await waiter
+
+    def schedule_release(self, now):
+        if self.timer is not None:
+            return
+        delay = self.get_next_event_time(now) - now
+        self.timer = asyncio.get_running_loop().call_later(max(delay, MIN_RELEASE_INTERVAL), self.release_waiters)
+
+    def release_waiters(self):
+        self.timer = None
+        now = time.monotonic()
+        while self.waiters and self.get_next_event_time(now) <= now:
+            waiter = self.waiters.popleft()
+            if waiter.done():  # Cancelled while waiting
+                continue
+            self.add_event(now)
+            waiter.set_result(None)
+        while self.waiters and self.waiters[0].done():
+            self.waiters.popleft()
+        if self.waiters:
+            self.schedule_release(now)
+
+    def report_flood_wait(self, value):
+        # Returns True if the limiter is paused, so its users will wait anyway.
+        now = time.monotonic()
+        self.flood_waits += 1
+        self.flood_wait_times.append(now)
+        while self.flood_wait_times[0] < now - self.period:
+            self.flood_wait_times.popleft()
+        if len(self.flood_wait_times) < self.flood_wait_threshold:
+            return now < self.paused_until
+        self.flood_wait_times.clear()
+        self.paused_until = max(self.paused_until, now + value)
+        self.ramp_duration = max(value, self.period)
+        self.last_event = now
+        self.pauses += 1
+        self.controller.log.info(f'{self.full_name}: приостановлен на {value} секунд из-за FloodWait')
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.waiters:
+            self.schedule_release(now)
+        return True
 
     @property
     def is_old(self):
-        return not self.static and time.time() - self.events[-1] >= self.period
+        if self.static or self.waiters:
+            return False
+        now = time.monotonic()
+        return now >= self.paused_until and (not self.events or now - self.events[-1] >= self.period)
+
+    @property
+    def idle_time(self):
+        return time.monotonic() - self.last_event
@@ -0,0 +1,183 @@
+import asyncio
+import json
+
+from sqlalchemy import delete, func, insert, select
+
+from tgdog.db import tables
+from tgdog.messages import QueuedMessage
+
+DELETE_CHUNK_SIZE = 500
+RETRY_DELAY = 5
+
+
+class MessageSpool:
+
+    def __init__(self, controller, watermark):
+        self.controller = controller
+        self.watermark = watermark
+        self.pending_rows = []
+        self.sent_messages = []
+        # Until the messages left from the previous run are counted,
+        # everything goes to the database, so that the order is preserved.
+        self.replaying = True
+        self.spilled = {priority: 0 for priority in self.controller.message_queues}
+        self.last_loaded_ids = {priority: 0 for priority in self.controller.message_queues}
+        self.event = asyncio.Event()
+        # Messages left from the previous run are replayed even if nothing is sent after the start.
+        self.event.set()
+        self.lock = asyncio.Lock()
+
+    def put(self, message):
+        if message.finish_event is not None:
+            # Nobody will wait for this message after restart.
+            return False
+        try:
+            data = json.dumps([message.args, message.kwargs])
+        except (TypeError, ValueError):
+            return False
+        message.spooled = True
+        row = {
+            'chat_id': message.chat_id,
+            'priority': message.priority,
+            'text': message.text,
+            'data': data,
+        }
+        queue = self.controller.message_queues[message.priority]
+        if self.replaying or self.spilled[message.priority] or len(queue) >= self.watermark:
+            self.spilled[message.priority] += 1
+            self.pending_rows.append((None, row))
+        else:
+            self.pending_rows.append((message, row))
+            self.controller.enqueue_message(message)
+        self.event.set()
+        return True
+
+    def mark_sent(self, message):
+        self.sent_messages.append(message)
+        self.event.set()
+
+    def notify_dequeued(self, priority):
+        if self.spilled[priority] and len(self.controller.message_queues[priority]) < self.watermark // 2:
+            self.event.set()
+
+    async def worker(self):
+        while True:
+            await self.event.wait()
+            self.event.clear()
+            try:
+                await self.flush()
+            except Exception:
+                self.controller.log.exception('Ошибка при синхронизации очереди сообщений с базой данных:')
+                await asyncio.sleep(RETRY_DELAY)
+                self.event.set()
+
+    async def flush(self):
+        async with self.lock:
+            if self.replaying:
+                async with self.controller.session() as session:
+                    await self.count_spilled_messages(session)
+                self.replaying = False
+            await self.write()
+            async with self.controller.session() as session:
+                await self.load_spilled_messages(session)
+
+    async def close(self):
+        async with self.lock:
+            await self.write()
+
+    async def write(self):
+        pending_rows, self.pending_rows = self.pending_rows, []
+        sent_messages = []
+        last_loaded_ids = dict(self.last_loaded_ids)
+        try:
+            async with self.controller.session() as session, session.begin():
+                await self.insert_rows(session, pending_rows)
+                # Messages sent while the rows were being inserted already have their ids.
+                sent_messages, self.sent_messages = self.sent_messages, []
+                await self.delete_sent_messages(session, sent_messages)
+        except BaseException:
+            for message, row in pending_rows:
+                if message is not None:
+                    message.spool_id = None
+            self.last_loaded_ids = last_loaded_ids
+            self.pending_rows[:0] = pending_rows
+            self.sent_messages[:0] = sent_messages
+            raise
+
+    async def insert_rows(self, session, pending_rows):
+        # Messages that were sent before they got into the database do not need to be stored at all.
+        pending_rows = [(m, row) for m, row in pending_rows if m is None or not m.done]
+        if not pending_rows:
+            return
+        stmt = insert(tables.SpooledMessage).returning(
+            tables.SpooledMessage.id,
+            sort_by_parameter_order=True,
+        )
+        ids = (await session.scalars(stmt, [row for message, row in pending_rows])).all()
+        for (message, row), spool_id in zip(pending_rows, ids):
+            if message is None:
+                continue
+            message.spool_id = spool_id
+            if spool_id > self.last_loaded_ids[message.priority]:
+                self.last_loaded_ids[message.priority] = spool_id
+
+    async def delete_sent_messages(self, session, sent_messages):
+        ids = [m.spool_id for m in sent_messages if m.spool_id is not None]
+        for i in range(0, len(ids), DELETE_CHUNK_SIZE):
+            await session.execute(delete(tables.SpooledMessage).where(
+                tables.SpooledMessage.id.in_(ids[i:i+DELETE_CHUNK_SIZE])
+            ))
+
+    async def count_spilled_messages(self, session):
+        stmt = select(
+            tables.SpooledMessage.priority,
+            func.count(),
+        ).group_by(tables.SpooledMessage.priority)
+        counts = (await session.execute(stmt)).all()
+        self.spilled = dict.fromkeys(self.spilled, 0)
+        for priority, count in counts:
+            if priority not in self.spilled:
+                self.controller.log.warning(f'В очереди сообщений найдено {count} сообщений с неизвестным приоритетом {priority}')
+                continue
+            self.spilled[priority] = count
+        total = sum(self.spilled.values())
+        if total:
+            self.controller.log.info(f'В очереди сообщений осталось {total} сообщений с прошлого запуска')
+        # Messages spilled before the first write are not in the database yet.
+        for message, row in self.pending_rows:
+            if message is None:
+                self.spilled[row['priority']] += 1
+
+    async def load_spilled_messages(self, session):
+        for priority, queue in self.controller.message_queues.items():
+            if not self.spilled[priority] or len(queue) >= self.watermark // 2:
+                continue
+            limit = self.watermark - len(queue)
+            stmt = select(
+                tables.SpooledMessage.id,
+                tables.SpooledMessage.chat_id,
+                tables.SpooledMessage.text,
+                tables.SpooledMessage.data,
+            ).where(
+                tables.SpooledMessage.priority == priority,
+                tables.SpooledMessage.id > self.last_loaded_ids[priority],
+            ).order_by(tables.SpooledMessage.id).limit(limit)
+            # Messages spilled while the query is running are not among its rows and must stay counted.
+            spilled = self.spilled[priority]
+            rows = (await session.execute(stmt)).all()
+            spilled_during_load = self.spilled[priority] - spilled
+            for spool_id, chat_id, text, data in rows:
+                args, kwargs = json.loads(data)
+                message = QueuedMessage(chat_id, text, tuple(args), kwargs, priority, self.controller.message_id)
+                self.controller.message_id += 1
+                message.spooled = True
+                message.spool_id = spool_id
+                self.controller.enqueue_message(message)
+            if rows:
+                self.last_loaded_ids[priority] = rows[-1][0]
+            if len(rows) < limit:
+                self.spilled[priority] = spilled_during_load
+            else:
+                # Check again after this batch even if the counter says that nothing is left.
+                self.spilled[priority] = max(spilled - len(rows), 1) + spilled_during_load
+            self.controller.log.debug(f'Загружено {len(rows)} сообщений с приоритетом {priority} из базы данных')
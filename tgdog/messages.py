@@ -1,29 +1,125 @@
 import asyncio
 from collections import OrderedDict
+import uuid
 
+import pyrogram
 from pyrogram.enums.parse_mode import ParseMode
 from pyrogram.utils import get_peer_type
+from sqlalchemy import select
 
+from tgdog.db import tables
 from tgdog.helpers import split_text
+from tgdog.helpers.fair_queue import FairQueue
 from tgdog.limiter import Limiter
-from tgdog.helpers.prioritized_item import PrioritizedItem
+
+# Errors after which there is no point in sending anything else to the chat
+BLOCKED_CHAT_ERRORS = (
+    pyrogram.errors.ChannelPrivate,
+    pyrogram.errors.ChatWriteForbidden,
+    pyrogram.errors.InputUserDeactivated,
+    pyrogram.errors.PeerIdInvalid,
+    pyrogram.errors.UserDeactivated,
+    pyrogram.errors.UserDeactivatedBan,
+    pyrogram.errors.UserIsBlocked,
+)
+
+
+class QueuedMessage:
+    __slots__ = (
+        'chat_id',
+        'text',
+        'args',
+        'kwargs',
+        'priority',
+        'message_id',
+        'finish_event',
+        'previous_invoke_event',
+        'current_invoke_event',
+        'done',
+        'spooled',
+        'spool_id',
+    )
+
+    def __init__(
+        self,
+        chat_id,
+        text,
+        args,
+        kwargs,
+        priority,
+        message_id,
+        finish_event=None,
+    ):
+        self.chat_id = chat_id
+        self.text = text
+        self.args = args
+        self.kwargs = kwargs
+        self.priority = priority
+        self.message_id = message_id
+        self.finish_event = finish_event
+        self.previous_invoke_event = None
+        self.current_invoke_event = None
+        self.done = False
+        self.spooled = False
+        self.spool_id = None
+
+    @property
+    def ignore_errors(self):
+        return self.kwargs.get('ignore_errors', False)
+
+    def get_invoke_event(self):
+        # Created only when the next part of the chain has to wait for this one.
+        if self.current_invoke_event is None:
+            self.current_invoke_event = asyncio.Event()
+        return self.current_invoke_event
+
+
+class MessageEdit:
+    __slots__ = (
+        'chat_id',
+        'message_id',
+        'pending',
+        'finish_events',
+        'task',
+    )
+
+    def __init__(self, chat_id, message_id):
+        self.chat_id = chat_id
+        self.message_id = message_id
+        # Only the latest requested state is kept, (text, args, kwargs).
+        self.pending = None
+        self.finish_events = []
+        self.task = None
 
 
 class TGBotMessagesMixin:
 
     def __init__(self):
-        self.message_queue = asyncio.PriorityQueue()
+        self.message_queues = OrderedDict()
+        self.message_tasks = set()
+        self.message_sender_event = asyncio.Event()
+        self.max_concurrent_sendings_per_priority = None
+        self.message_spool = None
         self.message_id = 1
         self.global_message_limiter = Limiter(
             self,
             30,
             1,
-            name='broadcast_messages'
+            name='broadcast_messages',
+            # A single FloodWait is most likely about one chat, several of them within a second are about the bot.
+            flood_wait_threshold=3,
         )
         self.message_limiters = {}
         self.message_event_chains = {}
+        self.message_edits = {}
+        self.evicted_resources = {
+            'message_limiters': 0,
+            'message_event_chains': 0,
+            'chat_locks': 0,
+        }
         self.messages_info = OrderedDict()
         for priority in range(1, 4):
+            self.message_queues[priority] = FairQueue()
             self.messages_info[priority] = {'pending': 0, 'processing': 0}
         super().__init__()
 
@@ -33,8 +129,7 @@ class TGBotMessagesMixin:
     def get_message_texts(self, text, title='', **kwargs):
         return split_text.split_text_by_units(header=title, body=text, max_part_length=4096, **kwargs)
 
-    def send_message_sync(self, text, /, chat_id=None, *args, priority=2, blocking=False, **kwargs):
-        chat_id = chat_id or self.get_default_chat_id()
+    def get_message_limiter(self, chat_id):
         if chat_id not in self.message_limiters:
             if get_peer_type(chat_id) == 'user':
                 limiter = Limiter(self, 3, 1, name=f'user_{chat_id}', static=False)
@@ -43,44 +138,66 @@ class TGBotMessagesMixin:
             self.message_limiters[chat_id] = limiter
         else:
             limiter = self.message_limiters[chat_id]
-        kwargs['limiters'] = [self.global_message_limiter, limiter]
-        event_chain_key = (chat_id, priority)
-        if event_chain_key not in self.message_event_chains:
-            event_chain = {}
-        else:
-            event_chain = self.message_event_chains[event_chain_key]
-        info = self.messages_info[priority]
+        return limiter
+
+    def send_message_sync(self, text, /, chat_id=None, *args, priority=2, blocking=False, **kwargs):
+        messages = self.queue_message(text, chat_id, *args, priority=priority, blocking=blocking, **kwargs)
+        if blocking:
+            return messages[-1].finish_event
+
+    def queue_message(self, text, /, chat_id=None, *args, priority=2, blocking=False, **kwargs):
+        chat_id = chat_id or self.get_default_chat_id()
+        messages = []
         texts = self.get_message_texts(text, title=kwargs.pop('title', ''))
         self.log.debug(f'Постановка {len(texts)} частей сообщения в очередь с приоритетом {priority} ({"блокирующая" if blocking else "неблокирующая"} отправка, текущий id {self.message_id})')
         for i, text in enumerate(texts):
-            event_chain['current_invoke_event'] = asyncio.Event()
-            new_event_chain = {'previous_invoke_event': event_chain['current_invoke_event']}
-            self.message_event_chains[event_chain_key] = new_event_chain
-            send_message_coroutine = self.app.send_message(
-                chat_id,
-                text,
-                *args,
-                **kwargs|event_chain
-            )
             finish_event = None
             if blocking and i == len(texts)-1:
                 finish_event = asyncio.Event()
-            message_data = {
-                'coroutine': send_message_coroutine,
-                'priority': priority,
-                'message_id': self.message_id,
-                'chat_id': chat_id,
-                'ignore_errors': kwargs.get('ignore_errors', False),
-                'finish_event': finish_event,
-                'current_invoke_event': event_chain['current_invoke_event'],
-            }
-            event_chain = new_event_chain
-            self.message_queue.put_nowait(PrioritizedItem(priority, self.message_id, message_data))
-            info['pending'] += 1
+            # All parts share the same args and kwargs, the coroutine is created only when the part is dispatched.
+            message = QueuedMessage(
+                chat_id,
+                text,
+                args,
+                kwargs,
+                priority,
+                self.message_id,
+                finish_event,
+            )
             self.message_id += 1
+            messages.append(message)
+            if self.message_spool is None or not self.message_spool.put(message):
+                self.enqueue_message(message)
         self.log.debug(f'Сообщения поставлены в очередь (текущий id {self.message_id})')
-        if blocking:
-            return finish_event
+        return messages
+
+    def enqueue_message(self, message):
+        event_chain_key = (message.chat_id, message.priority)
+        previous_message = self.message_event_chains.get(event_chain_key)
+        if previous_message is not None and not previous_message.done:
+            message.previous_invoke_event = previous_message.get_invoke_event()
+        self.message_event_chains[event_chain_key] = message
+        self.message_queues[message.priority].append(message.chat_id, message)
+        self.messages_info[message.priority]['pending'] += 1
+        self.message_sender_event.set()
+
+    def discard_queued_message(self, message):
+        # Only a message that is not dispatched yet can be discarded, its finish event is set without a result.
+        if not self.message_queues[message.priority].remove(message.chat_id, message):
+            return False
+        self.messages_info[message.priority]['pending'] -= 1
+        message.done = True
+        if message.current_invoke_event:
+            message.current_invoke_event.set()
+        if message.spooled:
+            # The row is deleted, or not inserted at all if it is not written yet.
+            self.message_spool.mark_sent(message)
+        if message.finish_event:
+            message.finish_event.message = None
+            message.finish_event.exception = None
+            message.finish_event.set()
+        self.log.debug(f'Сообщение {message.message_id} удалено из очереди')
+        return True
 
     async def send_message(self, *args, **kwargs):
         event = self.send_message_sync(*args, **kwargs)
@@ -88,6 +205,172 @@ class TGBotMessagesMixin:
             await event.wait()
             return event.message
 
+    async def broadcast(self, text, recipients_query, name=None, chunk_size=100, priority=3, **kwargs):
+        # recipients_query must select chat ids in its first column,
+        # they are read in chunks ordered by id, so the progress is just the last processed id.
+        name = name or uuid.uuid4().hex
+        async with self.session() as session:
+            stmt = select(tables.Broadcast).where(tables.Broadcast.name == name)
+            progress = (await session.execute(stmt)).scalar()
+            if progress is None:
+                progress = tables.Broadcast(name=name, sent=0, failed=0, blocked=0, finished=False)
+                session.add(progress)
+                await session.commit()
+        if progress.finished:
+            self.log.info(f'Рассылка {name} уже завершена')
+        elif progress.last_chat_id is None:
+            self.log.info(f'Начата рассылка {name}')
+        else:
+            self.log.info(f'Рассылка {name} продолжена после чата {progress.last_chat_id}')
+        recipients = recipients_query.subquery()
+        chat_id_column = list(recipients.c)[0]
+        # Keep no more messages in the queue than the global limiter lets through at once.
+        semaphore = asyncio.Semaphore(self.global_message_limiter.amount)
+
+        def get_result(event):
+            if isinstance(event.exception, BLOCKED_CHAT_ERRORS):
+                return 'blocked'
+            if event.message is None:
+                return 'failed'
+            return 'sent'
+
+        async def send(chat_id):
+            async with semaphore:
+                messages = queued_messages[chat_id] = self.queue_message(
+                    text,
+                    chat_id,
+                    priority=priority,
+                    blocking=True,
+                    ignore_errors=True,
+                    **kwargs,
+                )
+                event = messages[-1].finish_event
+                await event.wait()
+            results[chat_id] = get_result(event)
+
+        async def save_progress():
+            async with self.session() as session:
+                session.add(progress)
+                await session.commit()
+        while not progress.finished:
+            stmt = select(chat_id_column).distinct().order_by(chat_id_column).limit(chunk_size)
+            if progress.last_chat_id is not None:
+                stmt = stmt.where(chat_id_column > progress.last_chat_id)
+            async with self.session() as session:
+                chat_ids = (await session.scalars(stmt)).all()
+            if not chat_ids:
+                progress.finished = True
+                await save_progress()
+                continue
+            queued_messages = {}
+            results = {}
+            try:
+                await asyncio.gather(*[send(chat_id) for chat_id in chat_ids])
+            except asyncio.CancelledError:
+                await self.cancel_broadcast_chunk(queued_messages, results, get_result)
+                self.record_broadcast_chunk(progress, chat_ids, results)
+                await save_progress()
+                self.log.info(f'Рассылка {name} прервана после чата {progress.last_chat_id}')
+                raise
+            self.record_broadcast_chunk(progress, chat_ids, results)
+            await save_progress()
+        self.log.info(f'Рассылка {name} завершена: отправлено {progress.sent}, ошибок {progress.failed}, заблокировано {progress.blocked}')
+        return {
+            'sent': progress.sent,
+            'failed': progress.failed,
+            'blocked': progress.blocked,
+        }
+
+    async def cancel_broadcast_chunk(self, queued_messages, results, get_result):
+        # Queued messages would still be sent after the cancellation and sent again when the broadcast is resumed,
+        # so they are discarded, and only the messages that are already being sent are waited for.
+        # Parts of a chat are dispatched in order, so if the first part is still queued, none of them is dispatched.
+        sending = {}
+        for chat_id, messages in queued_messages.items():
+            if chat_id in results:
+                continue
+            if self.discard_queued_message(messages[0]):
+                for message in messages[1:]:
+                    self.discard_queued_message(message)
+            else:
+                sending[chat_id] = messages[-1].finish_event
+        await asyncio.gather(*[event.wait() for event in sending.values()])
+        for chat_id, event in sending.items():
+            results[chat_id] = get_result(event)
+
+    def record_broadcast_chunk(self, progress, chat_ids, results):
+        # Only the recipients up to the first one without a result are recorded, the rest will get the message on resume.
+        for chat_id in chat_ids:
+            if chat_id not in results:
+                break
+            result = results[chat_id]
+            setattr(progress, result, getattr(progress, result) + 1)
+            progress.last_chat_id = chat_id
+
+    def edit_message_text_sync(self, chat_id, message_id, text, *args, **kwargs):
+        # At most one edit of a message is in progress, the edits requested meanwhile are collapsed into the latest one.
+        key = (chat_id, message_id)
+        edit = self.message_edits.get(key)
+        if edit is None:
+            edit = self.message_edits[key] = MessageEdit(chat_id, message_id)
+        elif edit.pending is not None:
+            self.log.debug(f'Ожидающее изменение сообщения {message_id} в чате {chat_id} заменено более новым')
+        edit.pending = (text, args, kwargs)
+        finish_event = asyncio.Event()
+        finish_event.message = None
+        edit.finish_events.append(finish_event)
+        if edit.task is None:
+            edit.task = asyncio.create_task(self.message_editor(edit))
+            self.message_tasks.add(edit.task)
+        return finish_event
+
+    async def edit_message_text(self, *args, **kwargs):
+        event = self.edit_message_text_sync(*args, **kwargs)
+        await event.wait()
+        return event.message
+
+    def discard_message_edit(self, chat_id, message_id):
+        # Drops the edit that has not been started yet, e. g. when the message is going to be deleted.
+        edit = self.message_edits.get((chat_id, message_id))
+        if edit is None or edit.pending is None:
+            return
+        edit.pending = None
+        for finish_event in edit.finish_events:
+            finish_event.set()
+        edit.finish_events = []
+
+    async def message_editor(self, edit):
+        try:
+            while edit.pending is not None:
+                (text, args, kwargs), edit.pending = edit.pending, None
+                finish_events, edit.finish_events = edit.finish_events, []
+                result = None
+                try:
+                    result = await self.app.edit_message_text(
+                        edit.chat_id,
+                        edit.message_id,
+                        text,
+                        *args,
+                        limiters=[self.global_message_limiter, self.get_message_limiter(edit.chat_id)],
+                        **kwargs,
+                    )
+                except pyrogram.errors.MessageNotModified:
+                    pass
+                except Exception:
+                    (self.log.info if kwargs.get('ignore_errors', False) else self.log.error)(
+                        f'Необработанное исключение при изменении сообщения {edit.message_id} в чате {edit.chat_id}:',
+                        exc_info=True
+                    )
+                finally:
+                    for finish_event in finish_events:
+                        finish_event.message = result
+                        finish_event.set()
+        finally:
+            for finish_event in edit.finish_events:
+                finish_event.set()
+            del self.message_edits[(edit.chat_id, edit.message_id)]
+            self.message_tasks.discard(edit.task)
+
     def send_warning_error_message_sync(self, *args, **kwargs):
         for dev_id in self.dev_ids:
             self.send_message_sync(
@@ -99,69 +382,102 @@ class TGBotMessagesMixin:
                 **kwargs,
             )
 
+    def evict_idle_message_resources(self, ttl):
+        evicted_limiters = [
+            chat_id for chat_id, limiter in self.message_limiters.items()
+            if limiter.is_old and limiter.idle_time >= ttl
+        ]
+        for chat_id in evicted_limiters:
+            del self.message_limiters[chat_id]
+        # Once the last queued part is sent, a new chain for the same key starts empty anyway.
+        evicted_event_chains = [
+            key for key, last_message in self.message_event_chains.items()
+            if last_message.done
+        ]
+        for key in evicted_event_chains:
+            del self.message_event_chains[key]
+        self.evicted_resources['message_limiters'] += len(evicted_limiters)
+        self.evicted_resources['message_event_chains'] += len(evicted_event_chains)
+        return len(evicted_limiters) + len(evicted_event_chains)
+
+    async def idle_resources_sweeper(self, interval, ttl):
+        while True:
+            await asyncio.sleep(interval)
+            evicted = self.evict_idle_message_resources(ttl)
+            evicted_chat_locks = self.app.dispatcher.evict_idle_chat_locks()
+            self.evicted_resources['chat_locks'] += evicted_chat_locks
+            evicted += evicted_chat_locks
+            if evicted:
+                self.log.debug(f'Удалено неиспользуемых ресурсов: {evicted}')
+
     async def message_sender(self, max_concurrent_sendings_per_priority):
-        def could_get_next_item():
-            next_item_priority = None
-            next_item_priority_queue_size = None
-            first_full_queue_priority = None
-            for priority, info in self.messages_info.items():
-                if next_item_priority is None and info['pending'] > 0:
-                    next_item_priority = priority
-                    next_item_priority_queue_size = info['processing']
-                if first_full_queue_priority is None and info['processing'] == max_concurrent_sendings_per_priority:
-                    first_full_queue_priority = priority
-                if next_item_priority is not None and first_full_queue_priority is not None:
-                    break
-            if first_full_queue_priority is None:
-                return True
-            if next_item_priority is None:
-                return False
-            if next_item_priority_queue_size >= max_concurrent_sendings_per_priority:
-                return False
-            return True
-        message_tasks = []
-        get_message_task = None
+        self.max_concurrent_sendings_per_priority = max_concurrent_sendings_per_priority
+        try:
+            while True:
+                self.dispatch_messages()
+                await self.message_sender_event.wait()
+                self.message_sender_event.clear()
+        except asyncio.CancelledError:
+            [t.cancel() for t in self.message_tasks]
+            raise
+
+    def dispatch_messages(self):
         while True:
-            if not get_message_task and could_get_next_item():
-                get_message_task = asyncio.create_task(self.message_queue.get())
-                message_tasks.append(get_message_task)
-            try:
-                done_tasks, pending_tasks = await asyncio.wait(message_tasks, return_when=asyncio.FIRST_COMPLETED)
-            except asyncio.CancelledError:
-                [t.cancel() for t in message_tasks]
-                raise
-            for task in done_tasks:
-                message_tasks.remove(task)
-                if task == get_message_task:
-                    get_message_task = None
-                    item = task.result()
-                    while True:
-                        priority = item.priority
-                        message_id = item.id
-                        message_data = item.item
-                        self.log.debug(f'Создаётся задача для отправки сообщения в чат {message_data["chat_id"]} с приоритетом {priority}, id {message_id}')
-                        message_task = asyncio.create_task(message_data['coroutine'])
-                        message_task.message_data = message_data
-                        message_tasks.append(message_task)
-                        info = self.messages_info[priority]
-                        info['pending'] -= 1
-                        info['processing'] += 1
-                        if self.message_queue.empty() or not could_get_next_item():
-                            break
-                        item = self.message_queue.get_nowait()
-                    continue
-                result = None
-                try:
-                    message_data = task.message_data
-                    result = task.result()
-                except Exception:
-                    message_data['current_invoke_event'].set()
-                    (self.log.info if message_data['ignore_errors'] else self.log.error)(
-                        f'Необработанное исключение при отправке сообщения {message_data["message_id"]}:',
-                        exc_info=True
-                    )
-                finally:
-                    self.messages_info[message_data['priority']]['processing'] -= 1
-                    if message_data['finish_event']:
-                        message_data['finish_event'].message = result
-                        message_data['finish_event'].set()
+            # Messages of a lower priority are sent only when there are no pending messages of a higher priority,
+            # except for messages to chats that are already busy with a message of that higher priority.
+            # Within a priority chats are served in turn, one message per chat at a time.
+            for priority, queue in self.message_queues.items():
+                if queue.ready:
+                    break
+            else:
+                return
+            info = self.messages_info[priority]
+            if info['processing'] >= self.max_concurrent_sendings_per_priority:
+                return
+            message = queue.popleft()
+            info['pending'] -= 1
+            info['processing'] += 1
+            if self.message_spool is not None:
+                self.message_spool.notify_dequeued(priority)
+            self.log.debug(f'Создаётся задача для отправки сообщения в чат {message.chat_id} с приоритетом {priority}, id {message.message_id}')
+            message_task = asyncio.create_task(self.app.send_message(
+                message.chat_id,
+                message.text,
+                *message.args,
+                limiters=[self.global_message_limiter, self.get_message_limiter(message.chat_id)],
+                previous_invoke_event=message.previous_invoke_event,
+                current_invoke_event=message.current_invoke_event,
+                **message.kwargs,
+            ))
+            message_task.message = message
+            message_task.add_done_callback(self.on_message_sent)
+            self.message_tasks.add(message_task)
+
+    def on_message_sent(self, task):
+        self.message_tasks.discard(task)
+        message = task.message
+        message.done = True
+        if message.current_invoke_event:
+            message.current_invoke_event.set()
+        result = None
+        exception = None
+        if task.cancelled():
+            self.log.debug(f'Отправка сообщения {message.message_id} отменена')
+        elif task.exception() is not None:
+            exception = task.exception()
+            (self.log.info if message.ignore_errors else self.log.error)(
+                f'Необработанное исключение при отправке сообщения {message.message_id}:',
+                exc_info=exception
+            )
+        else:
+            result = task.result()
+        if message.spooled and not task.cancelled():
+            # Cancelled messages stay in the spool and will be sent after restart.
+            self.message_spool.mark_sent(message)
+        self.messages_info[message.priority]['processing'] -= 1
+        self.message_queues[message.priority].release(message.chat_id)
+        if message.finish_event:
+            message.finish_event.message = result
+            message.finish_event.exception = exception
+            message.finish_event.set()
+        self.message_sender_event.set()
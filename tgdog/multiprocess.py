@@ -0,0 +1,344 @@
+import asyncio
+from io import BytesIO
+import itertools
+import logging
+import multiprocessing
+import pickle
+import socket
+import struct
+import threading
+
+import pyrogram
+from pyrogram.raw.core import TLObject
+
+from tgdog.helpers.raw_updates import get_update_peer_id
+from tgdog.logging_helpers import WarningErrorHandler
+
+FRAME_HEADER = struct.Struct('>I')
+INVOKE_ARGUMENTS = ('retries', 'timeout', 'sleep_threshold')
+
+
+async def read_frame(reader):
+    size = FRAME_HEADER.unpack(await reader.readexactly(FRAME_HEADER.size))[0]
+    return pickle.loads(await reader.readexactly(size))
+
+
+def write_frame(writer, frame):
+    data = pickle.dumps(frame, protocol=pickle.HIGHEST_PROTOCOL)
+    writer.write(FRAME_HEADER.pack(len(data)) + data)
+
+
+def encode_tl(value):
+    # Raw API results are TL objects, lists of them or plain python values.
+    if isinstance(value, TLObject):
+        return ('tl', value.write())
+    if isinstance(value, list):
+        return ('list', [encode_tl(v) for v in value])
+    return ('python', value)
+
+
+def decode_tl(value):
+    kind, data = value
+    if kind == 'tl':
+        return TLObject.read(BytesIO(data))
+    if kind == 'list':
+        return [decode_tl(v) for v in data]
+    return data
+
+
+def encode_packet(packet):
+    update, users, chats = packet
+    return (
+        update.write(),
+        [user.write() for user in users.values()],
+        [chat.write() for chat in chats.values()],
+    )
+
+
+def decode_packet(data):
+    update, users, chats = data
+    users = [TLObject.read(BytesIO(user)) for user in users]
+    chats = [TLObject.read(BytesIO(chat)) for chat in chats]
+    return (
+        TLObject.read(BytesIO(update)),
+        {user.id: user for user in users},
+        {chat.id: chat for chat in chats},
+    )
+
+
+def encode_error(e):
+    # Telegram errors are sent as code and message, so the worker rebuilds exactly the same exception.
+    if isinstance(e, pyrogram.errors.RPCError) and e.CODE is not None:
+        if isinstance(e.value, str) and e.value.startswith('['):
+            # Unknown errors keep the original "[code message]" as the value.
+            message = e.value.strip('[]').split(' ', 1)[-1]
+        elif e.ID and e.value is not None:
+            message = e.ID.replace('_X', f'_{e.value}', 1)
+        else:
+            message = e.ID or e.NAME
+        return ('rpc', e.CODE, message)
+    try:
+        return ('python', pickle.dumps(e))
+    except Exception:
+        return ('python', pickle.dumps(RuntimeError(repr(e))))
+
+
+def raise_error(error, query_type):
+    if error[0] == 'rpc':
+        pyrogram.errors.RPCError.raise_it(
+            pyrogram.raw.types.RpcError(error_code=error[1], error_message=error[2]),
+            query_type,
+        )
+    raise pickle.loads(error[1])
+
+
+class ForwardingQueue:
+    # Replaces the updates queue of the main process.
+    # Updates are sent to the worker processes right away, the worker is chosen by the chat,
+    # so updates of one chat are always handled by one process in the original order.
+
+    def __init__(self, connections):
+        self.connections = connections
+        self.unordered = itertools.cycle(connections)
+        self.stop_requests = asyncio.Queue()
+        self.forwarded_updates = 0
+
+    def qsize(self):
+        return 0
+
+    def empty(self):
+        return True
+
+    def put_nowait(self, packet):
+        if packet is None:
+            self.stop_requests.put_nowait(None)
+            return
+        peer_id = get_update_peer_id(packet[0])
+        if peer_id is None:
+            connection = next(self.unordered)
+        else:
+            connection = self.connections[hash(peer_id) % len(self.connections)]
+        connection.send(('update', encode_packet(packet)))
+        self.forwarded_updates += 1
+
+    async def get(self):
+        return await self.stop_requests.get()
+
+
+class WorkerConnection:
+    # Connection of the main process to one of the worker processes.
+
+    def __init__(self, controller, index, sock):
+        self.controller = controller
+        self.index = index
+        self.sock = sock
+        self.reader = None
+        self.writer = None
+        self.tasks = set()
+
+    async def open(self):
+        self.reader, self.writer = await asyncio.open_connection(sock=self.sock)
+
+    def send(self, frame):
+        if self.writer is not None and not self.writer.is_closing():
+            write_frame(self.writer, frame)
+
+    async def serve(self):
+        log = self.controller.log
+        try:
+            while True:
+                frame = await read_frame(self.reader)
+                if frame[0] == 'log':
+                    self.handle_record(logging.makeLogRecord(frame[1]))
+                    continue
+                task = asyncio.create_task(self.execute(*frame))
+                self.tasks.add(task)
+                task.add_done_callback(self.tasks.discard)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            if self.controller.canceling:
+                log.info(f'Рабочий процесс {self.index} отключился')
+                return
+            # Updates of the chats of this process would be lost, so the whole application is stopped.
+            log.error(f'Рабочий процесс {self.index} неожиданно отключился, приложение будет остановлено')
+            self.controller.stop()
+
+    def handle_record(self, record):
+        # The worker notifies the developers by itself, here the record only has to get into the logs.
+        for handler in self.controller.log.handlers:
+            if isinstance(handler, WarningErrorHandler) or record.levelno < handler.level:
+                continue
+            handler.handle(record)
+
+    async def execute(self, kind, call_id, *args):
+        try:
+            if kind == 'invoke':
+                query, kwargs = args
+                result = await self.controller.raw_invoke(decode_tl(query), **kwargs)
+            elif kind == 'resolve_peer':
+                result = await self.controller.raw_resolve_peer(args[0])
+            else:
+                raise ValueError(f'Unknown request type {kind}')
+            self.send(('result', call_id, encode_tl(result)))
+        except Exception as e:
+            self.send(('error', call_id, encode_error(e)))
+
+    async def close(self):
+        for task in list(self.tasks):
+            task.cancel()
+        if self.writer is None:
+            return
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except ConnectionError:
+            pass
+
+
+class MainProcessConnection:
+    # Connection of a worker process to the main process.
+
+    def __init__(self, controller, sock):
+        self.controller = controller
+        self.sock = sock
+        self.reader = None
+        self.writer = None
+        self.call_ids = itertools.count()
+        self.calls = {}
+
+    async def open(self):
+        self.reader, self.writer = await asyncio.open_connection(sock=self.sock)
+
+    def send(self, frame):
+        if self.writer.is_closing():
+            raise ConnectionError('Connection to the main process is closed')
+        write_frame(self.writer, frame)
+
+    async def call(self, kind, query_type, *args):
+        call_id = next(self.call_ids)
+        future = asyncio.get_running_loop().create_future()
+        self.calls[call_id] = (future, query_type)
+        try:
+            self.send((kind, call_id, *args))
+            return await future
+        finally:
+            self.calls.pop(call_id, None)
+
+    async def serve(self):
+        try:
+            while True:
+                frame = await read_frame(self.reader)
+                if frame[0] == 'update':
+                    self.controller.app.dispatcher.updates_queue.put_nowait(decode_packet(frame[1]))
+                    continue
+                kind, call_id, data = frame
+                future, query_type = self.calls.get(call_id, (None, None))
+                if future is None or future.done():
+                    continue
+                if kind == 'result':
+                    future.set_result(decode_tl(data))
+                    continue
+                try:
+                    raise_error(data, query_type)
+                except Exception as e:
+                    future.set_exception(e)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            self.controller.log.info('Соединение с главным процессом закрыто')
+        finally:
+            for future, query_type in self.calls.values():
+                if not future.done():
+                    future.set_exception(ConnectionError('Connection to the main process is lost'))
+            if self.controller.monitor_task:
+                self.controller.stop()
+            else:
+                self.controller.canceling = True
+
+
+class ProxyClient(pyrogram.Client):
+    # Client of a worker process, it does not connect to telegram by itself:
+    # raw requests and peer resolving are performed by the main process.
+    # Uploading and downloading files use separate media sessions and are not supported.
+
+    def __init__(self, *args, **kwargs):
+        kwargs['in_memory'] = True
+        super().__init__(*args, **kwargs)
+        self.main_process_connection = None
+
+    async def invoke(self, query, retries=None, timeout=None, sleep_threshold=None):
+        kwargs = {
+            name: value
+            for name, value in zip(INVOKE_ARGUMENTS, (retries, timeout, sleep_threshold))
+            if value is not None
+        }
+        return await self.main_process_connection.call('invoke', type(query), encode_tl(query), kwargs)
+
+    async def resolve_peer(self, peer_id):
+        return await self.main_process_connection.call('resolve_peer', TLObject, peer_id)
+
+    async def start(self):
+        await self.storage.open()
+        self.is_connected = True
+        self.is_initialized = True
+        await self.dispatcher.start()
+        self.me = await self.get_me()
+        return self
+
+    async def stop(self, block=True):
+        await self.dispatcher.stop()
+        self.is_initialized = False
+        self.is_connected = False
+        await self.storage.close()
+        return self
+
+
+class ProcessLogHandler(logging.Handler):
+    # Sends records of a worker process to the main process, which writes them to its own logs.
+
+    def __init__(self, connection):
+        super().__init__(logging.DEBUG)
+        self.connection = connection
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread_id = threading.get_ident()
+
+    def emit(self, record):
+        if self.connection.writer.is_closing():
+            # The main process has already stopped, there is nowhere to write the record to.
+            return
+        try:
+            data = dict(record.__dict__)
+            data['msg'] = record.getMessage()
+            data['args'] = None
+            if record.exc_info:
+                data['exc_text'] = logging.Formatter().formatException(record.exc_info)
+            data['exc_info'] = None
+            frame = ('log', data)
+            if threading.get_ident() == self.loop_thread_id:
+                self.connection.send(frame)
+            else:
+                self.loop.call_soon_threadsafe(self.connection.send, frame)
+        except Exception:
+            self.handleError(record)
+
+
+def start_worker_processes(controller):
+    context = multiprocessing.get_context('spawn')
+    connections = []
+    processes = []
+    for index in range(controller.processes):
+        main_socket, worker_socket = socket.socketpair()
+        process = context.Process(
+            target=run_worker_process,
+            args=(type(controller), controller.init_args, controller.init_kwargs, index, worker_socket),
+            name=f'{controller.bot_name}_{index}',
+        )
+        process.start()
+        worker_socket.close()
+        connections.append(WorkerConnection(controller, index, main_socket))
+        processes.append(process)
+    return connections, processes
+
+
+def run_worker_process(controller_class, init_args, init_kwargs, index, sock):
+    controller = controller_class(*init_args, **init_kwargs)
+    controller.worker_index = index
+    controller.main_process_socket = sock
+    asyncio.run(controller.start())
@@ -0,0 +1,119 @@
+import asyncio
+
+import pyrogram
+from pyrogram.raw.types import (
+    PeerUser,
+    UpdateBotCallbackQuery,
+    UpdateEditChannelMessage,
+    UpdateEditMessage,
+    UpdateInlineBotCallbackQuery,
+)
+
+from tgdog.helpers.raw_updates import get_update_peer, get_update_user_id
+
+
+class OverloadPolicy:
+    # admit and accept are called only while the updates queue is overloaded,
+    # put and take are called for every queued and every taken update.
+
+    def put(self, dispatcher, entry):
+        pass
+
+    def take(self, dispatcher, entry):
+        pass
+
+    def admit(self, dispatcher, entry):
+        # Called for an incoming update, return False to drop it.
+        return True
+
+    def accept(self, dispatcher, entry):
+        # Called for an update taken by a worker, return False to drop it.
+        return True
+
+
+class DropStaleCallbackQueries(OverloadPolicy):
+    # Telegram stops waiting for the answer after a few seconds anyway.
+
+    def __init__(self, max_age=5, text='Извините, бот сейчас перегружен.\nПожалуйста, попробуйте позже.'):
+        self.max_age = max_age
+        self.text = text
+        # Not added with add_task, since it is O(tasks) per call and queries are shed in bursts.
+        self.answer_tasks = set()
+
+    def accept(self, dispatcher, entry):
+        if not isinstance(entry.update, UpdateBotCallbackQuery) or entry.age < self.max_age:
+            return True
+        task = asyncio.create_task(self.answer(dispatcher.client, entry.update.query_id))
+        self.answer_tasks.add(task)
+        task.add_done_callback(self.answer_tasks.discard)
+        return False
+
+    async def answer(self, client, query_id):
+        # A stale query has most likely expired already, that is not worth a notification for every dropped update.
+        try:
+            await client.answer_callback_query(
+                str(query_id),
+                self.text,
+                show_alert=True,
+                ignore_errors=True,
+                max_attempts=1,
+            )
+        except pyrogram.errors.BadRequest as e:
+            client.controller.log.debug(f'Не удалось ответить на устаревший запрос {query_id}: {e}')
+        except Exception:
+            client.controller.log.exception(f'Необработанное исключение при ответе на устаревший запрос {query_id}:')
+
+
+class CollapseUserUpdates(OverloadPolicy):
+    # Of several queued updates of the same type from the same user only the last one is processed.
+    # By default only callback queries and edits are collapsed, earlier new messages carry their own content,
+    # so they are collapsed only if UpdateNewMessage is passed in update_types.
+    DEFAULT_UPDATE_TYPES = (
+        UpdateBotCallbackQuery,
+        UpdateInlineBotCallbackQuery,
+        UpdateEditMessage,
+        UpdateEditChannelMessage,
+    )
+
+    def __init__(self, update_types=None):
+        self.update_types = tuple(update_types) if update_types else self.DEFAULT_UPDATE_TYPES
+        self.last_entries = {}
+
+    def get_key(self, entry):
+        update = entry.update
+        if not isinstance(update, self.update_types):
+            return None
+        user_id = get_update_user_id(update)
+        if user_id is None:
+            return None
+        return (user_id, type(update))
+
+    def put(self, dispatcher, entry):
+        key = self.get_key(entry)
+        if key is not None:
+            self.last_entries[key] = entry
+
+    def accept(self, dispatcher, entry):
+        key = self.get_key(entry)
+        if key is None:
+            return True
+        return self.last_entries.get(key) is entry
+
+    def take(self, dispatcher, entry):
+        key = self.get_key(entry)
+        if key is not None and self.last_entries.get(key) is entry:
+            del self.last_entries[key]
+
+
+class PrioritizePrivateChats(OverloadPolicy):
+    # Updates from groups and channels are dropped until the queue is back to normal.
+
+    def is_private(self, entry):
+        peer = get_update_peer(entry.update)
+        return peer is None or isinstance(peer, PeerUser)
+
+    def admit(self, dispatcher, entry):
+        return self.is_private(entry)
+
+    def accept(self, dispatcher, entry):
+        return self.is_private(entry)
@@ -1,4 +1,13 @@
-from sqlalchemy import select
+from collections import OrderedDict
+import copy
+import datetime
+import decimal
+import enum
+import time
+
+from sqlalchemy import event, insert, inspect, select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import make_transient_to_detached
 
 from tgdog.db import db
 from tgdog.enums import Category
@@ -7,10 +16,135 @@ from tgdog.handler_decorators import on_callback_query, on_message
 from tgdog.helpers import ContextVarWrapper
 
 current_user = ContextVarWrapper('current_user')
+IMMUTABLE_TYPES = (
+    int, float, str, bytes, bool, type(None),
+    datetime.date, datetime.time, datetime.datetime, datetime.timedelta,
+    decimal.Decimal, enum.Enum,
+)
+DIALECT_INSERTS = {
+    'postgresql': postgresql.insert,
+    'sqlite': sqlite.insert,
+}
+EAGER_LOADING_STRATEGIES = ('joined', 'selectin', 'subquery', 'immediate')
+
+
+def copy_values(values):
+    # Cached values must not be shared with the rows, which can be changed in place.
+    return {
+        key: value if isinstance(value, IMMUTABLE_TYPES) else copy.deepcopy(value)
+        for key, value in values.items()
+    }
+
+
+class UserCache:
+    # Column values of user rows by telegram id, the least recently used rows are evicted first.
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, user_id):
+        entry = self.entries.get(user_id)
+        if entry is not None and time.monotonic() - entry[0] >= self.ttl:
+            del self.entries[user_id]
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(user_id)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, user_id, values):
+        if not self.max_size:
+            return
+        self.entries[user_id] = (time.monotonic(), values)
+        self.entries.move_to_end(user_id)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        if self.entries.pop(user_id, None) is not None:
+            self.invalidations += 1
+
+    def clear(self):
+        self.invalidations += len(self.entries)
+        self.entries.clear()
+
+    @property
+    def stats(self):
+        requests = self.hits + self.misses
+        return {
+            'size': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / requests if requests else 0,
+            # Every hit is a select that was not executed.
+            'round_trips_saved': self.hits,
+            'invalidations': self.invalidations,
+        }
 
 
 class TGBotUsersMixin:
 
+    def __init__(self):
+        self.user_cache = UserCache(self.user_cache_size, self.user_cache_ttl)
+        user_mapper = inspect(self.User)
+        self.user_columns = [attr.key for attr in user_mapper.column_attrs]
+        if self.user_cache_size and any(r.lazy in EAGER_LOADING_STRATEGIES for r in user_mapper.relationships):
+            # A cached row is attached without a select, so its eagerly loaded relationships would be missing.
+            raise ValueError('User cache cannot be used with eagerly loaded relationships of the user table')
+        super().__init__()
+
+    def listen_user_events(self):
+        if not self.user_cache_size:
+            return
+        event.listen(self.sync_session_class, 'after_flush', self.on_flush)
+        event.listen(self.sync_session_class, 'do_orm_execute', self.on_orm_execute)
+        event.listen(self.sync_session_class, 'after_commit', self.on_commit)
+        event.listen(self.sync_session_class, 'after_soft_rollback', self.on_soft_rollback)
+
+    def remove_user_events(self):
+        if not self.user_cache_size:
+            return
+        event.remove(self.sync_session_class, 'after_flush', self.on_flush)
+        event.remove(self.sync_session_class, 'do_orm_execute', self.on_orm_execute)
+        event.remove(self.sync_session_class, 'after_commit', self.on_commit)
+        event.remove(self.sync_session_class, 'after_soft_rollback', self.on_soft_rollback)
+
+    def on_flush(self, session, flush_context):
+        # The collections still describe the flushed changes here.
+        user_ids = set()
+        for target in [*session.dirty, *session.deleted]:
+            if not isinstance(target, self.User):
+                continue
+            # The telegram id itself may have been changed as well.
+            user_ids.update({target.user_id, *inspect(target).attrs.user_id.history.deleted})
+        if not user_ids:
+            return
+        for user_id in user_ids:
+            self.user_cache.invalidate(user_id)
+        session.info.setdefault('written_users', set()).update(user_ids)
+
+    def on_commit(self, session):
+        # Rows changed in this transaction could be cached by other sessions before the commit.
+        for user_id in session.info.pop('written_users', ()):
+            self.user_cache.invalidate(user_id)
+
+    def on_soft_rollback(self, session, previous_transaction):
+        session.info.pop('written_users', None)
+
+    def on_orm_execute(self, orm_execute_state):
+        # Bulk updates and deletes do not say which rows they change.
+        if not (orm_execute_state.is_update or orm_execute_state.is_delete):
+            return
+        if orm_execute_state.bind_mapper is not None and orm_execute_state.bind_mapper.class_ is self.User:
+            self.user_cache.clear()
+
     @on_callback_query(category=Category.INITIALIZE, group=group_manager.LOAD_USER)
     @on_message(category=Category.INITIALIZE, group=group_manager.LOAD_USER)
     async def load_user(self, update):
@@ -28,14 +162,36 @@ class TGBotUsersMixin:
         current_user.reset_context_var()
 
     async def get_or_create_user(self, user_id):
+        values = self.user_cache.get(user_id)
+        if values is not None:
+            user = self.User(**copy_values(values))
+            make_transient_to_detached(user)
+            # The row is attached to the session as is, without a select.
+            return await db.merge(user, load=False)
         stmt = select(self.User).where(
             self.User.user_id == user_id
         )
         user = (await db.execute(stmt)).scalar()
         if not user:
-            user = self.User(user_id=user_id)
-            db.add(user)
-            await db.commit()
-            await db.refresh(user)  # To avoid some strange errors when accessing attributes
-            self.log.info(f'Создан пользователь {user_id}')
+            result = await db.execute(self.make_user_insert(user_id))
+            user = (await db.execute(stmt)).scalar()
+            if result.rowcount:
+                self.log.info(f'Создан пользователь {user_id}')
+            # The new row is not committed yet, it is cached by the next update.
+            return user
+        loaded_values = inspect(user).dict
+        self.user_cache.put(user_id, copy_values({
+            key: loaded_values[key]
+            for key in self.user_columns
+            if key in loaded_values
+        }))
         return user
+
+    def make_user_insert(self, user_id):
+        # A user created concurrently by another update is not an error.
+        dialect = self.db_engine.dialect.name
+        if dialect in DIALECT_INSERTS:
+            return DIALECT_INSERTS[dialect](self.User).values(user_id=user_id).on_conflict_do_nothing()
+        if dialect in ('mysql', 'mariadb'):
+            return insert(self.User).values(user_id=user_id).prefix_with('IGNORE')
+        return insert(self.User).values(user_id=user_id)
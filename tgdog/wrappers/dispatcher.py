@@ -3,50 +3,200 @@ from collections import OrderedDict
 import inspect
 
 import pyrogram
-from pyrogram.raw.types import UpdateNewMessage, UpdateNewChannelMessage, UpdateBotCallbackQuery
-from pyrogram.utils import get_peer_id
+from pyrogram.utils import get_peer_type
 
 from tgdog.enums import Category
+from tgdog.helpers.raw_updates import get_update_peer_id, get_update_user_id
+from tgdog.multiprocess import ForwardingQueue
+from tgdog.wrappers.updates_queue import ChatUpdatesQueue, UpdatesQueue
+
+# Raw update type -> type of the handlers its parsed form is passed to, the same as pyrogram parsers return.
+UPDATE_HANDLER_TYPES = {}
+for update_types, handler_type in [
+    (pyrogram.dispatcher.Dispatcher.NEW_MESSAGE_UPDATES, pyrogram.handlers.MessageHandler),
+    (pyrogram.dispatcher.Dispatcher.EDIT_MESSAGE_UPDATES, pyrogram.handlers.EditedMessageHandler),
+    (pyrogram.dispatcher.Dispatcher.DELETE_MESSAGES_UPDATES, pyrogram.handlers.DeletedMessagesHandler),
+    (pyrogram.dispatcher.Dispatcher.CALLBACK_QUERY_UPDATES, pyrogram.handlers.CallbackQueryHandler),
+    (pyrogram.dispatcher.Dispatcher.USER_STATUS_UPDATES, pyrogram.handlers.UserStatusHandler),
+    (pyrogram.dispatcher.Dispatcher.BOT_INLINE_QUERY_UPDATES, pyrogram.handlers.InlineQueryHandler),
+    (pyrogram.dispatcher.Dispatcher.POLL_UPDATES, pyrogram.handlers.PollHandler),
+    (pyrogram.dispatcher.Dispatcher.CHOSEN_INLINE_RESULT_UPDATES, pyrogram.handlers.ChosenInlineResultHandler),
+    (pyrogram.dispatcher.Dispatcher.CHAT_MEMBER_UPDATES, pyrogram.handlers.ChatMemberUpdatedHandler),
+    (pyrogram.dispatcher.Dispatcher.CHAT_JOIN_REQUEST_UPDATES, pyrogram.handlers.ChatJoinRequestHandler),
+]:
+    for update_type in update_types:
+        UPDATE_HANDLER_TYPES[update_type] = handler_type
+
+
+class LazyUpdate:
+    # The update is parsed only when some handler other than RawUpdateHandler needs it.
+    __slots__ = ('parser', 'packet', 'parsed', 'parsed_update', 'error')
+
+    def __init__(self, parser, packet):
+        self.parser = parser
+        self.packet = packet
+        self.parsed = False
+        self.parsed_update = None
+        # A failed parse is not repeated for the following categories.
+        self.error = None
+
+    async def get(self):
+        if self.error is not None:
+            raise self.error
+        if not self.parsed:
+            if self.parser is not None:
+                try:
+                    self.parsed_update, handler_type = await self.parser(*self.packet)
+                except Exception as e:
+                    self.error = e
+                    raise
+            self.parsed = True
+        return self.parsed_update
+
+
+class HandlerTables:
+    # Never changed after creation, so a worker can keep using it while the handlers are being changed.
+
+    def __init__(self, categories, callback_query_routes):
+        self.categories = categories
+        # Callback data prefix (bytes) -> (handler, resolve), longer prefixes are tried first.
+        self.callback_query_routes = callback_query_routes
+        self.callback_query_route_lengths = sorted({len(p) for p in callback_query_routes}, reverse=True)
+        # (category, handler type) -> groups of handlers relevant to that type, built on demand.
+        self.tables = {}
+        # handler type -> whether any category has handlers relevant to it.
+        self.handled_types = {}
+
+    def has_handlers(self, handler_type):
+        result = self.handled_types.get(handler_type)
+        if result is None:
+            result = self.handled_types[handler_type] = any(
+                self.get(category, handler_type) for category in self.categories
+            ) or (handler_type is pyrogram.handlers.CallbackQueryHandler and bool(self.callback_query_routes))
+        return result
+
+    def find_callback_query_route(self, data):
+        if not data:
+            return None
+        for length in self.callback_query_route_lengths:
+            route = self.callback_query_routes.get(data[:length])
+            if route is not None:
+                return route
+        return None
+
+    def get(self, category, handler_type):
+        key = (category, handler_type)
+        table = self.tables.get(key)
+        if table is None:
+            # Each group becomes a list of (handler, is_raw, extra_args), groups without relevant handlers are skipped.
+            table = []
+            for group in self.categories[category].values():
+                relevant_handlers = []
+                for handler in group:
+                    if isinstance(handler, handler_type):
+                        relevant_handlers.append((handler, False, ()))
+                    elif isinstance(handler, pyrogram.handlers.RawUpdateHandler):
+                        relevant_handlers.append((handler, True, ()))
+                if relevant_handlers:
+                    table.append(relevant_handlers)
+            self.tables[key] = table
+        return table
 
 
 class Dispatcher(pyrogram.dispatcher.Dispatcher):
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.categories = {c: OrderedDict() for c in Category}
+        self.handler_tables = HandlerTables({c: OrderedDict() for c in Category}, {})
         self.chat_locks = {}
+        self.updates_queue = UpdatesQueue(self.admit_update)
+        self.updates_queue_watermark = None
+        self.overload_policies = []
+        self.overloaded = False
+        # Policy class name -> number of dropped updates.
+        self.shed_updates = {}
+        # Checked for every incoming raw update, before it is queued.
+        self.blocked_peer_ids = set()
+        self.blocked_chat_types = set()  # 'user', 'chat' or 'channel'
+        self.prefilters = []
+        self.prefiltered_updates = 0
+
+    @property
+    def categories(self):
+        return self.handler_tables.categories
+
+    def update_handlers(self, added=(), removed=(), added_routes=(), removed_routes=()):
+        # added and removed are iterables of (handler, category, group),
+        # added_routes of (callback data prefix, handler, resolve), removed_routes of prefixes.
+        # The new tables are built aside and swapped in at once,
+        # updates that are already being processed finish with the previous ones.
+        categories = {c: OrderedDict(groups) for c, groups in self.categories.items()}
+        changed_groups = set()
+
+        def get_group(category, group, create):
+            if category not in categories:
+                raise ValueError(f'Category {category} does not exist')
+            if group not in categories[category]:
+                if not create:
+                    raise ValueError(f'Group {group} does not exist')
+                categories[category][group] = []
+            elif (category, group) not in changed_groups:
+                categories[category][group] = list(categories[category][group])
+            changed_groups.add((category, group))
+            return categories[category][group]
+        for handler, category, group in added:
+            get_group(category, group, True).append(handler)
+        for handler, category, group in removed:
+            get_group(category, group, False).remove(handler)
+        for category, group in changed_groups:
+            if categories[category][group]:
+                categories[category][group] = tuple(categories[category][group])
+            else:
+                categories[category].pop(group)
+        for category in {category for category, group in changed_groups}:
+            categories[category] = OrderedDict(sorted(categories[category].items()))
+        callback_query_routes = dict(self.handler_tables.callback_query_routes)
+        for prefix, handler, resolve in added_routes:
+            if isinstance(prefix, str):
+                prefix = prefix.encode()
+            if not prefix:
+                raise ValueError('Callback data prefix cannot be empty')
+            if prefix in callback_query_routes:
+                raise ValueError(f'Callback data prefix {prefix} already used')
+            callback_query_routes[prefix] = (handler, resolve)
+        for prefix in removed_routes:
+            if isinstance(prefix, str):
+                prefix = prefix.encode()
+            del callback_query_routes[prefix]
+        self.handler_tables = HandlerTables(categories, callback_query_routes)
 
     async def add_handler(self, handler, category=Category.MAIN, group=0):
-        if category not in self.categories:
-            raise ValueError(f'Category {category} does not exist')
-        for lock in self.locks_list:
-            await lock.acquire()
-        try:
-            if group not in self.categories[category]:
-                self.categories[category][group] = []
-            self.categories[category][group].append(handler)
-            self.categories[category] = OrderedDict(
-                sorted(self.categories[category].items())
-            )
-        finally:
-            for lock in self.locks_list:
-                lock.release()
+        self.update_handlers(added=[(handler, category, group)])
+
+    async def add_handlers(self, handlers):
+        self.update_handlers(added=handlers)
 
     async def remove_handler(self, handler, category=Category.MAIN, group=0):
-        if category not in self.categories:
-            raise ValueError(f'Category {category} does not exist')
-        category = self.categories[category]
-        for lock in self.locks_list:
-            await lock.acquire()
-        try:
-            if group not in category:
-                raise ValueError(f'Group {group} does not exist')
-            category[group].remove(handler)
-            if not category[group]:
-                category.pop(group)
-        finally:
-            for lock in self.locks_list:
-                lock.release()
+        self.update_handlers(removed=[(handler, category, group)])
+
+    async def add_callback_query_route(self, prefix, handler, resolve=None):
+        # Callback queries whose data starts with the prefix go straight to the handler, before the groups of the MAIN category.
+        # resolve(data) may return additional arguments for the handler, they are passed right after the callback query.
+        self.update_handlers(added_routes=[(prefix, handler, resolve)])
+
+    async def remove_callback_query_route(self, prefix):
+        self.update_handlers(removed_routes=[prefix])
+
+    def evict_idle_chat_locks(self):
+        # asyncio.Lock has no public way to check for waiters,
+        # but a lock that nobody holds or waits for can be recreated at any moment.
+        evicted = [
+            peer_id for peer_id, lock in self.chat_locks.items()
+            if not lock.locked() and not lock._waiters
+        ]
+        for peer_id in evicted:
+            del self.chat_locks[peer_id]
+        return len(evicted)
 
     @staticmethod
     def get_handler_name(handler):
@@ -57,24 +207,51 @@ class Dispatcher(pyrogram.dispatcher.Dispatcher):
         except Exception:
             return 'Unknown handler'
 
-    async def handle_category(self, category, packet, parsed_update, handler_type):
+    async def handle_category(self, category, packet, lazy_update, handler_type, handler_tables=None):
         log = self.client.controller.log
         log.debug(f'Выполняется обработка категории {category.name}')
-        for group in self.categories[category].values():
-            for handler in group:
+        handler_tables = handler_tables or self.handler_tables
+        groups = handler_tables.get(category, handler_type)
+        if (
+            category == Category.MAIN
+            and handler_type is pyrogram.handlers.CallbackQueryHandler
+            and handler_tables.callback_query_routes
+        ):
+            data = packet[0].data
+            route = handler_tables.find_callback_query_route(data)
+            if route is not None:
+                handler, resolve = route
+                try:
+                    extra_args = resolve(data) if resolve is not None else ()
+                except Exception:
+                    log.exception(f'Необработанное исключение при разборе данных для обработчика {self.get_handler_name(handler)}:')
+                    return False
+                groups = [[(handler, False, extra_args)], *groups]
+        for group in groups:
+            for handler, is_raw, extra_args in group:
                 args = None
                 kwargs = None
-                if isinstance(handler, handler_type):
+                if not is_raw:
+                    parse_error = lazy_update.error
+                    try:
+                        parsed_update = await lazy_update.get()
+                    except Exception:
+                        if parse_error is None:
+                            log.exception('Необработанное исключение при разборе обновления:')
+                        if category == Category.FINALIZE:
+                            # Handlers that need the parsed update cannot run, the raw ones still have to.
+                            continue
+                        return False
                     parsed_update.args_for_handler = []
                     parsed_update.kwargs_for_handler = {}
                     try:
                         if await handler.check(self.client, parsed_update):
-                            args = (parsed_update, *parsed_update.args_for_handler)
+                            args = (parsed_update, *extra_args, *parsed_update.args_for_handler)
                             kwargs = {**parsed_update.kwargs_for_handler}
                     except Exception:
                         log.exception(f'Необработанное исключение при проверке обработчика {self.get_handler_name(handler)}:')
                         return False
-                elif isinstance(handler, pyrogram.handlers.RawUpdateHandler):
+                else:
                     args = packet
                     kwargs = {}
                 if args is None:
@@ -92,49 +269,140 @@ class Dispatcher(pyrogram.dispatcher.Dispatcher):
                 break
         return True
 
+    async def start(self):
+        controller = self.client.controller
+        self.updates_queue_watermark = controller.updates_queue_watermark
+        self.overload_policies = list(controller.overload_policies)
+        if controller.chat_queues and not isinstance(self.updates_queue, ForwardingQueue):
+            updates_queue = ChatUpdatesQueue(self.admit_update)
+            while not self.updates_queue.empty():
+                updates_queue.put_entry(self.updates_queue.get_nowait())
+            self.updates_queue = updates_queue
+        await super().start()
+
+    def check_overload(self):
+        if self.updates_queue_watermark is None:
+            return False
+        size = self.updates_queue.qsize()
+        log = self.client.controller.log
+        if not self.overloaded and size >= self.updates_queue_watermark:
+            self.overloaded = True
+            log.warning(f'Очередь обновлений переполнена ({size} обновлений)')
+        # The policies are turned off only when the queue is half empty, so they do not flap around the watermark.
+        elif self.overloaded and size <= self.updates_queue_watermark // 2:
+            self.overloaded = False
+            log.info(f'Очередь обновлений разгружена ({size} обновлений), отброшено всего: {sum(self.shed_updates.values())}')
+        return self.overloaded
+
+    def shed_update(self, policy, entry):
+        name = type(policy).__name__
+        self.shed_updates[name] = self.shed_updates.get(name, 0) + 1
+        self.client.controller.log.debug(f'Обновление {type(entry.update).__name__} отброшено ({name})')
+
+    def add_prefilter(self, prefilter):
+        # prefilter(update, users, chats) returns False for the updates that have to be dropped,
+        # it must be cheap, since it is called for every update.
+        self.prefilters.append(prefilter)
+
+    def run_hook(self, hook, *args, default):
+        # Prefilters and policies are called from the loop of pyrogram over the updates of one container,
+        # so an error is logged and decides only for the current update, the rest of the container is not lost.
+        try:
+            return hook(*args)
+        except Exception:
+            name = getattr(hook, '__qualname__', repr(hook))
+            self.client.controller.log.exception(f'Необработанное исключение в {name}:')
+            return default
+
+    def prefilter_update(self, packet):
+        update = packet[0]
+        if self.blocked_peer_ids or self.blocked_chat_types:
+            peer_id = get_update_peer_id(update)
+            if peer_id is not None:
+                if peer_id in self.blocked_peer_ids or get_peer_type(peer_id) in self.blocked_chat_types:
+                    return False
+            if self.blocked_peer_ids and get_update_user_id(update) in self.blocked_peer_ids:
+                return False
+        for prefilter in self.prefilters:
+            # An update is not dropped because of a broken prefilter.
+            if not self.run_hook(prefilter, *packet, default=True):
+                return False
+        return True
+
+    def admit_update(self, entry):
+        if not self.prefilter_update(entry.packet):
+            self.prefiltered_updates += 1
+            return False
+        if self.check_overload():
+            for policy in self.overload_policies:
+                if not self.run_hook(policy.admit, self, entry, default=True):
+                    self.shed_update(policy, entry)
+                    return False
+        for policy in self.overload_policies:
+            self.run_hook(policy.put, self, entry, default=None)
+        return True
+
+    def accept_update(self, entry):
+        accepted = True
+        if self.check_overload():
+            for policy in self.overload_policies:
+                if not self.run_hook(policy.accept, self, entry, default=True):
+                    self.shed_update(policy, entry)
+                    accepted = False
+                    break
+        for policy in self.overload_policies:
+            self.run_hook(policy.take, self, entry, default=None)
+        return accepted
+
     async def handler_worker(self, lock):
+        chat_queues = isinstance(self.updates_queue, ChatUpdatesQueue)
         while True:
-            packet = await self.updates_queue.get()
-            if packet is None:
+            item = await self.updates_queue.get()
+            if item is None:
                 break
+            if chat_queues:
+                key, entry = item
+            else:
+                entry = item
+            if not self.accept_update(entry):
+                if chat_queues:
+                    self.updates_queue.task_done(key)
+                continue
+            packet = entry.packet
             update, users, chats = packet
             chat_lock = None
-            if self.client.controller.worker_per_chat:
-                peer = None
-                if isinstance(update, (UpdateNewMessage, UpdateNewChannelMessage)):
-                    peer = update.message.peer_id
-                if isinstance(update, UpdateBotCallbackQuery):
-                    peer = update.peer
-                if peer is not None:
-                    peer_id = get_peer_id(peer)
+            if self.client.controller.worker_per_chat and not chat_queues:
+                peer_id = get_update_peer_id(update)
+                if peer_id is not None:
                     if peer_id not in self.chat_locks:
                         self.chat_locks[peer_id] = asyncio.Lock()
                     chat_lock = self.chat_locks[peer_id]
             if chat_lock is not None:
                 await chat_lock.acquire()
             try:
-                parser = self.update_parsers.get(type(update), None)
-                parsed_update, handler_type = (
-                    await parser(update, users, chats)
-                    if parser is not None
-                    else (None, type(None))
-                )
+                handler_type = UPDATE_HANDLER_TYPES.get(type(update), type(None))
+                # All categories of one update are handled with the same set of handlers.
+                handler_tables = self.handler_tables
+                if not handler_tables.has_handlers(handler_type):
+                    continue
                 kwargs = {
                     'packet': packet,
-                    'parsed_update': parsed_update,
+                    'lazy_update': LazyUpdate(self.update_parsers.get(type(update), None), packet),
                     'handler_type': handler_type,
+                    'handler_tables': handler_tables,
                 }
-                async with lock:
-                    if not await self.handle_category(Category.INITIALIZE, **kwargs):
-                        await self.handle_category(Category.FINALIZE, **kwargs)
-                        continue
-                    if await self.handle_category(Category.MAIN, **kwargs):
-                        await self.handle_category(Category.FINISH, **kwargs)
-                    else:
-                        await self.handle_category(Category.RESTORE, **kwargs)
+                if not await self.handle_category(Category.INITIALIZE, **kwargs):
                     await self.handle_category(Category.FINALIZE, **kwargs)
+                    continue
+                if await self.handle_category(Category.MAIN, **kwargs):
+                    await self.handle_category(Category.FINISH, **kwargs)
+                else:
+                    await self.handle_category(Category.RESTORE, **kwargs)
+                await self.handle_category(Category.FINALIZE, **kwargs)
             except Exception:
                 self.client.controller.log.exception('Необработанное исключение при обработке обновления:')
             finally:
                 if chat_lock is not None:
                     chat_lock.release()
+                if chat_queues:
+                    self.updates_queue.task_done(key)
@@ -0,0 +1,113 @@
+import asyncio
+from collections import deque
+import itertools
+import time
+
+from tgdog.helpers.fair_queue import FairQueue
+from tgdog.helpers.raw_updates import get_update_peer_id
+
+
+class UpdateEntry:
+    __slots__ = ('packet', 'time')
+
+    def __init__(self, packet):
+        self.packet = packet
+        self.time = time.monotonic()
+
+    @property
+    def update(self):
+        return self.packet[0]
+
+    @property
+    def age(self):
+        return time.monotonic() - self.time
+
+
+class UpdatesQueue(asyncio.Queue):
+    # pyrogram puts (update, users, chats) packets, workers get UpdateEntry objects.
+
+    def __init__(self, admit=None):
+        super().__init__()
+        # Called for every incoming update, returns False if the update has to be dropped.
+        self.admit = admit
+
+    def put_nowait(self, packet):
+        if packet is None:
+            super().put_nowait(None)
+            return
+        entry = UpdateEntry(packet)
+        if self.admit is None or self.admit(entry):
+            super().put_nowait(entry)
+
+    def put_entry(self, entry):
+        super().put_nowait(entry)
+
+
+class ChatUpdatesQueue:
+    # Replaces asyncio.Queue of the dispatcher.
+    # Updates of one chat are given out one at a time, the next one only after task_done,
+    # so workers never wait for each other and updates of other chats are not blocked by a busy chat.
+
+    def __init__(self, admit=None):
+        self.admit = admit
+        self.queue = FairQueue()
+        self.getters = deque()
+        self.stop_requests = 0
+        # Updates without a chat are not ordered, each of them gets its own key.
+        self.unordered_keys = itertools.count()
+
+    def qsize(self):
+        return len(self.queue)
+
+    def empty(self):
+        return not len(self.queue)
+
+    def put_nowait(self, packet):
+        if packet is None:
+            self.stop_requests += 1
+            self.wakeup()
+            return
+        entry = UpdateEntry(packet)
+        if self.admit is None or self.admit(entry):
+            self.put_entry(entry)
+
+    def put_entry(self, entry):
+        key = get_update_peer_id(entry.update)
+        if key is None:
+            key = ('unordered', next(self.unordered_keys))
+        self.queue.append(key, (key, entry))
+        self.wakeup()
+
+    def wakeup(self):
+        while self.getters:
+            if not self.queue.ready and not (self.stop_requests and self.empty()):
+                return
+            getter = self.getters.popleft()
+            if not getter.done():
+                getter.set_result(None)
+                # The woken getter wakes up the next one if there is still something to take.
+                return
+
+    async def get(self):
+        # Returns (key, entry) or None when the dispatcher is stopping.
+        while True:
+            if self.queue.ready:
+                item = self.queue.popleft()
+                self.wakeup()
+                return item
+            if self.stop_requests and self.empty():
+                self.stop_requests -= 1
+                self.wakeup()
+                return None
+            getter = asyncio.get_running_loop().create_future()
+            self.getters.append(getter)
+            try:
+                await getter
+            except asyncio.CancelledError:
+                if not getter.cancelled():
+                    self.wakeup()
+                raise
+
+    def task_done(self, key):
+        self.queue.release(key)
+        self.wakeup()